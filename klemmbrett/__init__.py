@@ -1,24 +1,23 @@
 #!/usr/bin/env python
 
+import os as _os
+import signal as _signal
 import weakref as _weakref
 import logging as _logging
+import itertools as _it
+import collections as _collections
 
-import notify2 as _notify
-
-import gi as _gi
-_gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk as _gtk
-_gi.require_version('Gdk', '3.0')
-from gi.repository import Gdk as _gdk
 from gi.repository import GObject as _gobject
-_gi.require_version('Keybinder', '3.0')
-from gi.repository import Keybinder as _keybinder
-
-import dbus as _dbus
+from gi.repository import GLib as _glib
 
 import klemmbrett.util as _util
+import klemmbrett.rich as _rich
 import klemmbrett.config as _config
 
+# only needed to capture images and markup, which takes a display
+_gtk = _util.Repository('Gtk', '3.0')
+_gdk = _util.Repository('Gdk', '3.0')
+
 
 _log = _logging.getLogger(__name__)
 
@@ -32,20 +31,30 @@ class Klemmbrett(_gobject.GObject):
     __gsignals__ = {
         "text-selected": (_gobject.SIGNAL_RUN_FIRST, None, (_gobject.TYPE_PYOBJECT,)),
         "text-set": (_gobject.SIGNAL_RUN_FIRST, None, (_gobject.TYPE_PYOBJECT,)),
+        "rich-selected": (_gobject.SIGNAL_RUN_FIRST, None, (_gobject.TYPE_PYOBJECT,)),
     }
 
     _PLUGIN_PREFIX = "plugin "
     _TIE_PREFIX = "tie:"
+    _COALESCE = {
+        "clipboard": 0,
+        "primary": 100,
+    }
 
-    def __init__(self, config_files):
+    def __init__(self, config_files, backend = None):
         super(Klemmbrett, self).__init__()
-        self._clipboard = _gtk.Clipboard.get(_gdk.SELECTION_CLIPBOARD)
-        self._primary = _gtk.Clipboard.get(_gdk.SELECTION_PRIMARY)
 
+        self._config_files = config_files
         self.config = _config.Config()
         self.config.read(config_files)
 
-        _keybinder.init()
+        # the desktop, or a stand-in for it
+        if backend is None:
+            backend = _util.load_dotted(
+                self.config.get('klemmbrett', 'backend', 'klemmbrett.backend.GtkBackend'),
+            )(self.config)
+        self.backend = backend
+        self._clipboard, self._primary = self.backend.clipboards()
 
         # configure klemmbrett
         self._plugins = dict()
@@ -53,16 +62,54 @@ class Klemmbrett(_gobject.GObject):
 
         self._sync = _util.humanbool(self.config.get('klemmbrett', 'sync', True))
 
-        self.selection = None
+        # owner changes arriving within the coalescing window (in ms) of a
+        # selection are collapsed into a single read after the burst ended
+        self._names = {
+            self._clipboard: "clipboard",
+            self._primary: "primary",
+        }
+        self._coalesce = dict(
+            (cb, int(self.config.get('klemmbrett', '%s-coalesce' % (name,), self._COALESCE[name])))
+            for cb, name in self._names.items()
+        )
+        self._timeouts = dict()
+
+        # selections we write are served on request instead of being copied
+        # into them up front
+        self._offers = dict()
+        if self.backend.DISPLAY and _util.humanbool(self.config.get('klemmbrett', 'lazy-offers', True)):
+            self._offers = dict(zip((self._clipboard, self._primary), self.backend.offers()))
+
+        # digest of the current selection, the text itself is not kept
+        # around, it may be large and is in the history anyway
+        self._selected = None
+        # markup copied along with the current selection, if any
+        self.rich_selection = None
+        # the clip of the current selection, we hold a reference to it
+        # while it is, whoever keeps it longer takes their own
+        self._held = None
+
+        # images and markup are captured into the rich store, only a
+        # descriptor of them is handed on
+        self.rich = None
+        if self.backend.DISPLAY and _util.humanbool(self.config.get('klemmbrett', 'rich-capture', False)):
+            self.rich = _rich.RichStore(
+                _os.path.expanduser(self.config.get('klemmbrett', 'rich-store', '~/.klemmbrett.rich')),
+                int(self.config.get('klemmbrett', 'thumbnail-cache', 32)),
+            )
+
+        # clipboard reads are asynchronous, every owner change gets a serial
+        # and only the newest read per clipboard is allowed to finish
+        self._serials = _it.count(1)
+        self._pending = dict()
+        self._applied = 0
+        # selections we own because we just wrote them
+        self._echoes = dict()
+        self.stats = _collections.Counter()
 
         self._clipboard.connect('owner-change', self._clipboard_owner_changed)
         self._primary.connect('owner-change', self._clipboard_owner_changed)
 
-        try:
-            _notify.init("Klemmbrett")
-        except _dbus.exceptions.DBusException:
-            _log.error("Could not register with notification interface, notifications will not work properly", exc_info=True)
-
     def _load_plugins(self):
         for section in self.config.sections():
             if not section.startswith(self._PLUGIN_PREFIX):
@@ -72,6 +119,9 @@ class Klemmbrett(_gobject.GObject):
             opts = dict(self.config.items(section))
             # load the plugin module and create an instance
             plugin = _util.load_dotted(opts['plugin'])
+            if plugin.WIDGET and not self.backend.DISPLAY:
+                _log.info("Skipping plugin %r, it needs a display", name)
+                continue
             plugin = plugin(
                 name,
                 dict(plugin.OPTIONS, **opts),
@@ -101,38 +151,249 @@ class Klemmbrett(_gobject.GObject):
             plugin.bootstrap()
 
     def _clipboard_owner_changed(self, clipboard, event):
-        text = clipboard.wait_for_text()
-
-        if text != self.selection and text is not None:
-            self.selection = text
-            if self._sync:
-                if clipboard is self._primary:
-                    self._clipboard.set_text(text, -1)
-                elif clipboard is self._clipboard:
-                    self._primary.set_text(text, -1)
-
-            self.emit("text-selected", text)
+        if self._echoes.pop(clipboard, False):
+            # we just wrote this selection ourselves, there is nothing to read
+            self.stats["echoes-suppressed"] += 1
+            return True
+
+        if not self._coalesce[clipboard]:
+            self._request_text(clipboard)
+            return True
+
+        source = self._timeouts.pop(clipboard, None)
+        if source is not None:
+            _glib.source_remove(source)
+            self.stats["%s-coalesced" % (self._names[clipboard],)] += 1
+
+        self._timeouts[clipboard] = _glib.timeout_add(
+            self._coalesce[clipboard],
+            self._burst_ended,
+            clipboard,
+        )
+        return True
 
+    def _burst_ended(self, clipboard):
+        del self._timeouts[clipboard]
+        self._request_text(clipboard)
+        return False
+
+    def _request_text(self, clipboard):
+        serial = next(self._serials)
+        if clipboard in self._pending:
+            self.stats["reads-superseded"] += 1
+        self._pending[clipboard] = serial
+        if self.rich is not None:
+            clipboard.request_targets(self._targets_received, serial)
+        else:
+            clipboard.request_text(self._text_received, serial)
+
+    def _accept(self, clipboard, serial):
+        """ Finish the read with serial, unless it was overtaken by another one """
+        if self._pending.get(clipboard) != serial:
+            # a newer owner change already issued another read
+            return False
+
+        del self._pending[clipboard]
+
+        if serial < self._applied:
+            # the other selection changed later and its read finished first
+            self.stats["reads-outdated"] += 1
+            return False
+        self._applied = serial
         return True
 
+    def _text_received(self, clipboard, text, serial):
+        if self._accept(clipboard, serial) and text is not None:
+            self._select(text, (clipboard,))
+
+    def _targets_received(self, clipboard, atoms, *args):
+        # the number of atoms is passed along by some gtk versions
+        serial = args[-1]
+        if self._pending.get(clipboard) != serial:
+            return
+
+        atoms = atoms or []
+        names = set(atom.name() for atom in atoms)
+        if _gtk.targets_include_image(atoms, True) and not _gtk.targets_include_text(atoms):
+            self.stats["images"] += 1
+            clipboard.request_image(self._image_received, serial)
+        elif "text/html" in names:
+            self.stats["html"] += 1
+            clipboard.request_contents(_gdk.Atom.intern("text/html", False), self._html_received, serial)
+        elif "text/uri-list" in names:
+            clipboard.request_uris(self._uris_received, serial)
+        else:
+            clipboard.request_text(self._text_received, serial)
+
+    def _image_received(self, clipboard, pixbuf, serial):
+        if self._accept(clipboard, serial) and pixbuf is not None:
+            clip = self.rich.put_image(pixbuf)
+            self._select_rich(clip, (clipboard,))
+            clip.discard()
+
+    def _html_received(self, clipboard, data, serial):
+        if self._pending.get(clipboard) != serial:
+            return
+
+        html = data.get_data() if data is not None else None
+        if not html:
+            clipboard.request_text(self._text_received, serial)
+            return
+        # the text is kept along with the markup, to show and paste as text
+        clipboard.request_text(self._html_text_received, (serial, html))
+
+    def _html_text_received(self, clipboard, text, args):
+        serial, html = args
+        if self._accept(clipboard, serial):
+            clip = self.rich.put_html(html, text)
+            # still a text selection, the markup just comes along with it
+            self._select(clip.text, (clipboard,), rich = clip)
+            clip.discard()
+
+    def _uris_received(self, clipboard, uris, serial):
+        # file lists are kept as text, the uri list comes along to be
+        # offered again, like markup
+        if self._accept(clipboard, serial) and uris:
+            clip = self.rich.put_uris(uris)
+            self._select(clip.text, (clipboard,), rich = clip)
+            clip.discard()
+
+    def _select(self, text, written, source = None, rich = None):
+        """
+            Make text the current selection, written lists the selections
+            already holding it and rich describes markup that came with it
+        """
+        digest = _util.digest(text)
+        if digest == self._selected and rich is None:
+            return
+
+        self._selected = digest
+        self.rich_selection = rich
+        self._hold(rich)
+        if self._sync:
+            for clipboard in (self._clipboard, self._primary):
+                if clipboard in written:
+                    continue
+                if rich is not None:
+                    self._write_rich(clipboard, rich)
+                else:
+                    self._write(clipboard, text, source = source)
+
+        self.emit("text-selected", text)
+
+    def _select_rich(self, clip, written):
+        """ Like _select, for images, which come without any text """
+        self._selected = clip.digest
+        self.rich_selection = None
+        self._hold(clip)
+        self.emit("rich-selected", clip)
+
+    def _hold(self, clip):
+        if clip is not None:
+            clip.retain()
+        if self._held is not None:
+            self._held.discard()
+        self._held = clip
+
+    def _write(self, clipboard, text, contents = None, source = None):
+        """
+            Put text into clipboard. With lazy offers it is loaded by calling
+            source when an application asks for it, so the text does not
+            have to stay in memory.
+        """
+        offer = self._offers.get(clipboard)
+        if offer is not None:
+            if source is None:
+                source = lambda: text
+            if offer.offer(source, contents):
+                self._written(clipboard)
+                return
+        clipboard.set_text(text, -1)
+        self._written(clipboard)
+
+    def _write_rich(self, clipboard, clip):
+        if clip.image:
+            clipboard.set_image(clip.pixbuf())
+            self._written(clipboard)
+        else:
+            # markup and uri lists are only read from the store when asked
+            # for, they are kept for as long as they are offered
+            data = lambda: clip.data
+            clip.retain()
+            _weakref.finalize(data, clip.discard)
+            self._write(clipboard, clip.text, {clip.mime: data})
+
+    def _written(self, clipboard):
+        # the owner change caused by this write is ours, and any read still
+        # in flight or waiting for a burst to end is outdated now
+        self._echoes[clipboard] = True
+        self._pending.pop(clipboard, None)
+        source = self._timeouts.pop(clipboard, None)
+        if source is not None:
+            _glib.source_remove(source)
+
     def notify(self, summary, text):
         """ Display a message about the new suggestion and its origin """
-        n = _notify.Notification(summary, text)
-        n.show()
+        self.backend.notify(summary, text)
 
-    def set(self, text, primary = True, clipboard = True):
+    def bind(self, keystr, handler, *args):
+        """ Call handler with keystr and args whenever the shortcut keystr is pressed """
+        return self.backend.bind(keystr, handler, *args)
+
+    def unbind(self, keystr):
+        self.backend.unbind(keystr)
+
+    def set(self, text, primary = True, clipboard = True, source = None):
+        """
+            Make text the contents of the selections, source optionally
+            loads it again from where it is stored, e.g. the history
+        """
         try:
+            written = []
             if clipboard:
-                self._clipboard.set_text(text, -1)
+                self._write(self._clipboard, text, source = source)
+                written.append(self._clipboard)
             if primary:
-                self._primary.set_text(text, -1)
+                self._write(self._primary, text, source = source)
+                written.append(self._primary)
+
+            self._applied = next(self._serials)
+            self._select(text, written)
             self.emit("text-set", text)
         except TypeError:
             # TypeError: Gtk.Clipboard.set_text() argument 1 must be string, not None
             # FIXME(mbra): i really do not know when and when this happens :/
             pass
 
+    def set_rich(self, clip, primary = True, clipboard = True):
+        """ Put contents from the rich store back into the selections """
+        written = []
+        if clipboard:
+            self._write_rich(self._clipboard, clip)
+            written.append(self._clipboard)
+        if primary and not clip.image:
+            self._write_rich(self._primary, clip)
+            written.append(self._primary)
+
+        self._applied = next(self._serials)
+        if clip.image:
+            self._select_rich(clip, written)
+        else:
+            self._select(clip.text, written, rich = clip)
+        self.emit("text-set", clip.text)
+
+    def reload(self, *args):
+        """ Read the configuration again and let plugins pick up changed items """
+        self.config = _config.Config()
+        self.config.read(self._config_files)
+
+        for plugin in self._plugins.values():
+            if hasattr(plugin, "reload"):
+                plugin.reload()
+        return True
+
     def main(self):
-        _gtk.main()
+        _glib.unix_signal_add(_glib.PRIORITY_DEFAULT, _signal.SIGHUP, self.reload)
+        self.backend.main()
 
 
@@ -1,12 +1,10 @@
 # coding: utf-8
 
-import gi as _gi
-_gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk as _gtk
-from gi.repository import GdkPixbuf as _pixbuf
+import klemmbrett.util as _util
 
+_gtk = _util.Repository('Gtk', '3.0')
+_pixbuf = _util.Repository('GdkPixbuf', '2.0')
 
-import klemmbrett.util as _util
 
 def about(event):
     dialog = _gtk.AboutDialog()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+"""
+The parts of the desktop klemmbrett talks to: the selections, global
+shortcuts, notifications and the main loop. `GtkBackend` is the real
+thing, `MemoryBackend` keeps everything in memory so the core and its
+plugins run without a display, e.g. to replay clipboard traffic:
+
+::
+    [klemmbrett]
+    backend = klemmbrett.backend.MemoryBackend
+
+    >>> kb = klemmbrett.Klemmbrett(config_files)
+    >>> kb.backend.replay(kb, texts, rate = 1000)
+    {'events': 10000, 'selected': 10000, 'throughput': 998.2, ...}
+
+Without a display there are no widgets, popups only record their items
+so they can be picked from:
+
+::
+    >>> kb.backend.press("<Ctrl><Alt>S")
+    True
+    >>> kb.backend.choose(0)
+    'blah'
+"""
+
+import time as _time
+import logging as _logging
+
+from gi.repository import GLib as _glib
+
+import klemmbrett.util as _util
+import klemmbrett.offer as _offer
+
+# only the GtkBackend needs these, they are imported once it is used
+_gtk = _util.Repository('Gtk', '3.0')
+_gdk = _util.Repository('Gdk', '3.0')
+_gdkx11 = _util.Repository('GdkX11', '3.0')
+_keybinder = _util.Repository('Keybinder', '3.0')
+
+_log = _logging.getLogger(__name__)
+
+
+class GtkBackend(object):
+
+    # whether there are widgets, selections offered on request, images
+    DISPLAY = True
+
+    def __init__(self, config):
+        import notify2
+        import dbus
+
+        self._notify = notify2
+        _keybinder.init()
+        try:
+            self._notify.init("Klemmbrett")
+        except dbus.exceptions.DBusException:
+            _log.error("Could not register with notification interface, notifications will not work properly", exc_info=True)
+
+    def clipboards(self):
+        """ Return the CLIPBOARD and PRIMARY selections """
+        return (
+            _gtk.Clipboard.get(_gdk.SELECTION_CLIPBOARD),
+            _gtk.Clipboard.get(_gdk.SELECTION_PRIMARY),
+        )
+
+    def offers(self):
+        return (
+            _offer.Offer(_gdk.SELECTION_CLIPBOARD),
+            _offer.Offer(_gdk.SELECTION_PRIMARY),
+        )
+
+    def bind(self, keystr, handler, *args):
+        return _keybinder.bind(keystr, handler, *args)
+
+    def unbind(self, keystr):
+        _keybinder.unbind(keystr)
+
+    def event_time(self):
+        """ The time of the event that triggered the current shortcut """
+        return _keybinder.get_current_event_time()
+
+    def ungrab_keyboard(self):
+        """ Release the keyboard grabbed for the shortcut, so a popup can take it """
+        dm = _gdkx11.X11DeviceManagerCore(display=_gdk.Display.get_default())
+        for dev in dm.list_devices(_gdk.DeviceType.MASTER):
+            if dev.get_source() == _gdk.InputSource.KEYBOARD:
+                dev.ungrab(self.event_time())
+
+    def popup(self, plugin, items = None):
+        """ Show the menu of plugin, or one for items, at the pointer """
+        menu, index = plugin.menu(items)
+        menu.popup(
+            None,
+            None,
+            None,
+            None,
+            0,
+            self.event_time(),
+        )
+        menu.set_active(index)
+        return True
+
+    def notify(self, summary, text):
+        n = self._notify.Notification(summary, text)
+        n.show()
+
+    def main(self):
+        _gtk.main()
+
+
+class MemoryClipboard(object):
+    """
+        Stands in for a Gtk.Clipboard, owner changes and reads are delivered
+        from the main loop like the real ones
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.text = None
+        self._handlers = []
+
+    def connect(self, signal, handler, *args):
+        if signal != "owner-change":
+            raise ValueError("Unknown signal %r" % (signal,))
+        self._handlers.append((handler, args))
+        return len(self._handlers)
+
+    def set_text(self, text, length = -1):
+        self.text = text if length < 0 else text[:length]
+        _glib.idle_add(self._owner_changed)
+
+    # another application taking the selection looks the same
+    copy = set_text
+
+    def _owner_changed(self):
+        for handler, args in self._handlers:
+            handler(self, None, *args)
+        return False
+
+    def request_text(self, callback, data = None):
+        text = self.text
+
+        def deliver():
+            callback(self, text, data)
+            return False
+        _glib.idle_add(deliver)
+
+
+class MemoryBackend(object):
+
+    DISPLAY = False
+
+    def __init__(self, config):
+        self.clipboard = MemoryClipboard("clipboard")
+        self.primary = MemoryClipboard("primary")
+        self.bindings = dict()
+        self.notifications = []
+        # the plugin whose popup is showing and its items
+        self.shown = None
+        self._loop = None
+
+    def clipboards(self):
+        return (self.clipboard, self.primary)
+
+    def bind(self, keystr, handler, *args):
+        self.bindings[keystr] = (handler, args)
+        return True
+
+    def unbind(self, keystr):
+        self.bindings.pop(keystr, None)
+
+    def press(self, keystr):
+        """ Act as if the shortcut keystr was pressed """
+        handler, args = self.bindings[keystr]
+        return handler(keystr, *args)
+
+    def event_time(self):
+        return 0
+
+    def ungrab_keyboard(self):
+        pass
+
+    def popup(self, plugin, items = None):
+        self.shown = (plugin, list(plugin.items() if items is None else items))
+        return True
+
+    def choose(self, pos):
+        """ Act as if the item at pos of the showing popup was picked """
+        plugin, items = self.shown
+        label, value = items[pos]
+        if _util.isgenerator(value):
+            # a submenu, it is showing now
+            self.shown = (plugin, list(value()))
+            return label
+        self.shown = None
+        plugin.set(None, value)
+        return label
+
+    def notify(self, summary, text):
+        self.notifications.append((summary, text))
+
+    def main(self):
+        self._loop = _glib.MainLoop()
+        self._loop.run()
+
+    def pump(self, until = None):
+        """ Run the main loop until nothing is left to do, or until the given time """
+        context = _glib.MainContext.default()
+        while True:
+            if context.pending():
+                context.iteration(False)
+            elif until is not None and _time.perf_counter() < until:
+                _time.sleep(min(0.001, until - _time.perf_counter()))
+            else:
+                return
+
+    def settle(self, klemmbrett, timeout = 5):
+        """ Run the main loop until klemmbrett has no reads left outstanding """
+        deadline = _time.perf_counter() + timeout
+        while _time.perf_counter() < deadline:
+            self.pump()
+            if not klemmbrett._timeouts and not klemmbrett._pending:
+                return True
+            _time.sleep(0.0005)
+        return False
+
+    def replay(self, klemmbrett, texts, rate = None, selection = "clipboard"):
+        """
+            Copy every text into the selection as another application
+            would, rate times a second or as fast as they are taken in,
+            and report how long it took until each of them was selected
+        """
+        clipboard = getattr(self, selection)
+        copied = dict()
+        latencies = []
+
+        def selected(widget, text):
+            start = copied.pop(text, None)
+            if start is not None:
+                latencies.append(_time.perf_counter() - start)
+        handler = klemmbrett.connect("text-selected", selected)
+
+        events = 0
+        start = _time.perf_counter()
+        try:
+            for events, text in enumerate(texts, 1):
+                if rate:
+                    self.pump(until = start + (events - 1) / float(rate))
+                copied[text] = _time.perf_counter()
+                clipboard.copy(text)
+                if not rate:
+                    self.pump()
+            self.settle(klemmbrett)
+        finally:
+            klemmbrett.disconnect(handler)
+        elapsed = _time.perf_counter() - start
+
+        latencies.sort()
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+        return {
+            "events": events,
+            "selected": len(latencies),
+            "elapsed": elapsed,
+            "throughput": events / elapsed if elapsed else None,
+            "latency-p50": percentile(0.5),
+            "latency-p95": percentile(0.95),
+            "latency-p99": percentile(0.99),
+            "latency-max": latencies[-1] if latencies else None,
+        }
@@ -1,7 +1,9 @@
-import re as _re
 import os as _os
+import functools as _ft
+import collections as _collections
 
 import klemmbrett.util as _util
+import klemmbrett.callable.transform as _transform
 
 
 def newline_to_comma_quoted(options, plugin):
@@ -10,7 +12,7 @@ def newline_to_comma_quoted(options, plugin):
             text = plugin.history.top
         except IndexError:
             return None
-        return "'" + "','".join(_re.split(r"\s+", text.strip())) + "'"
+        return _transform.join(_transform.quote(_transform.split(text)), ",")
     return n2cq
 
 
@@ -20,7 +22,7 @@ def newline_to_comma(options, plugin):
             text = plugin.history.top
         except IndexError:
             return None
-        return text.strip().replace("\n", ",")
+        return _transform.join(_transform.split(text, "\n"), ",")
     return n2c
 
 
@@ -30,23 +32,79 @@ def newline_to_space(options, plugin):
             text = plugin.history.top
         except IndexError:
             return None
-        return text.strip().replace("\n", " ")
+        return _transform.join(_transform.split(text, "\n"), " ")
     return n2s
 
 
+def _mtime(path):
+    try:
+        return _os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
 def fswalker(options, plugin):
+    """
+        Browse a directory tree, directories are only read once they are
+        opened and are read again only after their mtime changed
+    """
+    size = int(options.get("dir-cache", 256))
+    # path -> (mtime, [(name, path, isdir), ...]) of recently read directories
+    cache = _collections.OrderedDict()
+
+    def scan(base):
+        mtime = _os.stat(base).st_mtime_ns
+        try:
+            cached_mtime, entries = cache[base]
+        except KeyError:
+            pass
+        else:
+            if cached_mtime == mtime:
+                cache.move_to_end(base)
+                for entry in entries:
+                    yield entry
+                return
+
+        # the entries are handed out while the directory is read, so huge
+        # directories can be paged through, and only get cached once they
+        # have been read completely
+        entries = []
+        with _os.scandir(base) as it:
+            for entry in it:
+                if entry.name.startswith("."):
+                    continue
+
+                # the type comes from the directory listing itself, no
+                # need to stat every entry
+                if entry.is_file():
+                    entry = (entry.name, entry.path, False)
+                elif entry.is_dir():
+                    entry = (entry.name, entry.path, True)
+                else:
+                    continue
+
+                entries.append(entry)
+                yield entry
+
+        cache[base] = (mtime, entries)
+        cache.move_to_end(base)
+        while len(cache) > size:
+            cache.popitem(last = False)
+
+    root = options.get("base", _os.getenv("HOME"))
+
     def walk(base = None):
         if base is None:
-            base = options.get("base", _os.getenv("HOME"))
-
-        for item in _os.listdir(base):
-            if item.startswith("."):
-                continue
+            base = root
 
-            path = _os.path.join(base, item)
-            if _os.path.isfile(path):
+        for item, path, isdir in scan(base):
+            if isdir:
+                sub = _util.yieldwrap(walk, path)
+                # opened submenus are kept until the directory changes
+                sub.stamp = _ft.partial(_mtime, path)
+                yield (item, sub)
+            else:
                 yield (item, path)
-            elif _os.path.isdir(path):
-                yield (item, _util.yieldwrap(walk, path))
 
+    walk.stamp = _ft.partial(_mtime, root)
     return walk
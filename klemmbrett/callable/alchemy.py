@@ -1,16 +1,87 @@
+import re as _re
+import time as _time
+import itertools as _it
+import threading as _threading
+import collections as _collections
 
 import sqlalchemy as _sa
 
+# bind parameters the way sqlalchemy.text() detects them
+_BIND = _re.compile(r'(?<![:\w\x5c]):(\w+)(?!:)', _re.UNICODE)
+
+_engines = dict()
+_engines_lock = _threading.Lock()
+
+
+def engine(url, options):
+    """ Return the engine shared by all statements using url, create it on first use """
+    with _engines_lock:
+        try:
+            return _engines[url]
+        except KeyError:
+            pass
+
+        kwargs = dict(pool_pre_ping = True)
+        if not url.startswith("sqlite"):
+            # sqlite does not pool connections the same way
+            kwargs["pool_size"] = int(options.get("pool-size", 2))
+            kwargs["max_overflow"] = int(options.get("max-overflow", 0))
+
+        _engines[url] = _sa.create_engine(url, **kwargs)
+        return _engines[url]
+
+
 def statement(options, plugin):
+    query = _sa.sql.text(options["statement"])
+    # the history entries referenced as :0, :1, ... by the statement
+    indices = sorted(set(int(name) for name in _BIND.findall(options["statement"]) if name.isdigit()))
+
+    ttl = float(options.get("query-cache-ttl", 0))
+    size = int(options.get("query-cache-size", 128))
+    cache = _collections.OrderedDict()
+    lock = _threading.Lock()
+
+    def params():
+        if not indices:
+            return dict()
+        history = _it.islice(plugin.history, indices[-1] + 1)
+        wanted = set(indices)
+        return dict((str(pos), text) for pos, text in enumerate(history) if pos in wanted)
+
+    def cache_key():
+        """ Identify the history entries the statement is run with, without loading them """
+        if not indices:
+            return None
+        entries = _it.islice(plugin.history.entries(), indices[-1] + 1)
+        wanted = set(indices)
+        return tuple(entry.digest for pos, entry in enumerate(entries) if pos in wanted)
+
     def stmt():
-        return str(
-            list(
-                _sa.create_engine(options["engine"]).execute(
-                    _sa.sql.text(options["statement"]),
-                    dict(
-                        ((str(x), y) for x, y in enumerate(list(plugin.history)))
-                    )
-                )
-            )[0][0]
-        )
+        bound = params()
+        key = tuple(sorted(bound.items()))
+
+        if ttl:
+            with lock:
+                hit = cache.get(key)
+                if hit is not None and hit[0] > _time.time():
+                    cache.move_to_end(key)
+                    return hit[1]
+
+        with engine(options["engine"], options).connect() as conn:
+            # only the first column of the first row is used, so only
+            # fetch that instead of the whole result
+            row = conn.execute(query, bound).first()
+
+        result = None if row is None else str(row[0])
+
+        if ttl:
+            with lock:
+                cache[key] = (_time.time() + ttl, result)
+                cache.move_to_end(key)
+                while len(cache) > size:
+                    cache.popitem(last = False)
+
+        return result
+
+    stmt.cache_key = cache_key
     return stmt
@@ -0,0 +1,178 @@
+"""
+Composable text transforms for snippets.
+
+A transform is a chain of stages separated by ``|``, every stage works on
+the items produced by the one before it, the items of the first stage are
+produced lazily from the clipboard contents so the chain runs in a single
+pass over the text without copying it:
+
+::
+    [snippet in list]
+    callable = klemmbrett.callable.transform.pipeline
+    pipeline = split | dedupe | quote ' | join ,
+
+Stages:
+
+    split [separator]   split on the separator, on whitespace runs by default
+    lines               split on line breaks
+    strip               strip whitespace off every item
+    nonempty            drop empty items
+    quote [char]        wrap every item in char, ' by default
+    dedupe              drop items seen before
+    sort                sort the items, this one has to keep them all
+    join [separator]    join all items, with a newline by default, this has
+                        to be the last stage and is added if it is missing
+
+Arguments are separated by whitespace, write \s, \t and \n for a space,
+tab or newline inside of them.
+"""
+
+import io as _io
+import re as _re
+import inspect as _inspect
+
+_NONSPACE = _re.compile(r'\S+')
+
+
+def _bounds(text):
+    """ Start and end of text without leading and trailing whitespace, without copying it """
+    m = _NONSPACE.search(text)
+    if m is None:
+        return 0, 0
+
+    end = len(text)
+    while end > m.start() and text[end - 1].isspace():
+        end -= 1
+    return m.start(), end
+
+
+def split(text, separator = None):
+    """ Lazily split the stripped text like re.split/str.split would """
+    start, end = _bounds(text)
+
+    if separator is None:
+        for m in _NONSPACE.finditer(text, start, end):
+            yield m.group()
+        return
+
+    pos = start
+    while True:
+        found = text.find(separator, pos, end)
+        if found == -1:
+            yield text[pos:end]
+            return
+        yield text[pos:found]
+        pos = found + len(separator)
+
+
+def lines(items):
+    for item in items:
+        for line in _io.StringIO(item):
+            yield line.rstrip("\r\n")
+
+
+def strip(items):
+    return (item.strip() for item in items)
+
+
+def nonempty(items):
+    return (item for item in items if item)
+
+
+def quote(items, char = "'"):
+    return (char + item + char for item in items)
+
+
+def dedupe(items):
+    seen = set()
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            yield item
+
+
+def sort(items):
+    return iter(sorted(items))
+
+
+def join(items, separator = "\n"):
+    out = _io.StringIO()
+    first = True
+    for item in items:
+        if not first:
+            out.write(separator)
+        out.write(item)
+        first = False
+    return out.getvalue()
+
+
+_STAGES = {
+    "lines": lines,
+    "strip": strip,
+    "nonempty": nonempty,
+    "quote": quote,
+    "dedupe": dedupe,
+    "sort": sort,
+    "join": join,
+}
+
+# arguments are separated by whitespace, so these stand in for it
+_ESCAPES = (
+    ("\\n", "\n"),
+    ("\\t", "\t"),
+    ("\\s", " "),
+)
+
+
+def _unescape(arg):
+    for escape, char in _ESCAPES:
+        arg = arg.replace(escape, char)
+    return arg
+
+
+def parse(spec):
+    """ Turn a pipeline spec into a function transforming text """
+    stages = []
+    for part in spec.split("|"):
+        words = part.split()
+        if not words:
+            raise ValueError("Empty stage in pipeline %r" % (spec,))
+        name, args = words[0], [_unescape(arg) for arg in words[1:]]
+        if name != "split" and name not in _STAGES:
+            raise ValueError("Unknown pipeline stage %r" % (name,))
+        # the first parameter of every stage takes the text or the items
+        try:
+            _inspect.signature(split if name == "split" else _STAGES[name]).bind(None, *args)
+        except TypeError:
+            raise ValueError("Too many arguments for pipeline stage %r in %r" % (name, spec))
+        stages.append((name, args))
+
+    # join turns the items into the final text, nothing can follow it
+    for name, args in stages[:-1]:
+        if name == "join":
+            raise ValueError("join has to be the last stage of pipeline %r" % (spec,))
+
+    if stages[-1][0] != "join":
+        stages.append(("join", []))
+
+    def transform(text):
+        items = None
+        for name, args in stages:
+            if items is None:
+                # the first stage gets its items straight from the text
+                items = split(text, *args) if name == "split" else _STAGES[name](split(text, "\n"), *args)
+            elif name == "split":
+                items = (part for item in items for part in split(item, *args))
+            else:
+                items = _STAGES[name](items, *args)
+        return items
+
+    return transform
+
+
+def pipeline(options, plugin):
+    transform = parse(options["pipeline"])
+
+    def run():
+        return transform(plugin.history.top)
+    return run
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+import logging as _logging
+
+import klemmbrett.util as _util
+
+_gtk = _util.Repository('Gtk', '3.0')
+_gdk = _util.Repository('Gdk', '3.0')
+
+_log = _logging.getLogger(__name__)
+
+_TEXT = 0
+_DATA = 1
+
+_TARGETS = (
+    ("UTF8_STRING", _TEXT),
+    ("text/plain;charset=utf-8", _TEXT),
+    ("text/plain", _TEXT),
+    ("STRING", _TEXT),
+    ("TEXT", _TEXT),
+)
+
+
+class Offer(object):
+    """
+        Owns a selection and hands out its contents only when another
+        application asks for them, instead of copying them into the
+        selection up front. Nothing but a reference to the source is kept
+        while the selection is ours, and it is dropped once it is not.
+    """
+
+    def __init__(self, selection):
+        self._selection = selection
+        self._widget = _gtk.Invisible()
+        self._widget.connect("selection-get", self._selection_get)
+        self._widget.connect("selection-clear-event", self._selection_clear)
+        self._source = None
+        self._contents = dict()
+
+    def offer(self, source, contents = None):
+        """
+            Take the selection, source is called to get the text once it
+            is requested. contents maps further targets, like the markup
+            or file list the text was copied with, to functions returning
+            their data.
+        """
+        self._contents = contents or dict()
+
+        _gtk.selection_clear_targets(self._widget, self._selection)
+        targets = _TARGETS + tuple((target, _DATA) for target in self._contents)
+        for target, info in targets:
+            self._widget.selection_add_target(
+                self._selection,
+                _gdk.Atom.intern(target, False),
+                info,
+            )
+
+        self._source = source
+        if not _gtk.selection_owner_set(self._widget, self._selection, _gdk.CURRENT_TIME):
+            self._source = None
+            return False
+        return True
+
+    def _selection_get(self, widget, data, info, time):
+        if self._source is None:
+            return
+
+        if info == _DATA:
+            target = data.get_target()
+            data.set(target, 8, self._contents[target.name()]())
+        else:
+            text = self._source()
+            if text is None:
+                # the source is gone, e.g. the entry left the history
+                _log.warning("Contents of the selection are not available any more")
+                return
+            data.set_text(text, -1)
+
+    def _selection_clear(self, widget, event):
+        # someone else owns the selection now
+        self._source = None
+        self._contents = dict()
+        return True
@@ -1,31 +1,34 @@
 #!/usr/bin/env python
 
 import os as _os
-import re as _re
+import math as _math
+import time as _time
+import zlib as _zlib
+import shlex as _shlex
+import heapq as _heapq
+import lzma as _lzma
 import itertools as _it
 import functools as _ft
-import pickle as _pickle
 import weakref as _weakref
 import logging as _logging
+import threading as _threading
 import collections as _collections
+import concurrent.futures as _futures
 
-import gi as _gi
-
-_gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk as _gtk
-
-_gi.require_version('Gdk', '3.0')
-from gi.repository import Gdk as _gdk
-from gi.repository import GdkX11 as _gdkx11
 from gi.repository import GObject as _gobject
-
-_gi.require_version('Keybinder', '3.0')
-from gi.repository import Keybinder as _keybinder
+from gi.repository import GLib as _glib
 
 import klemmbrett.util as _util
 import klemmbrett as _klemmbrett
 import klemmbrett.about as _about
 import klemmbrett.config as _config
+import klemmbrett.search as _search
+import klemmbrett.process as _process
+import klemmbrett.storage as _storage
+
+# menus and windows are only built with a display
+_gtk = _util.Repository('Gtk', '3.0')
+_gdk = _util.Repository('Gdk', '3.0')
 
 _log = _logging.getLogger(__name__)
 
@@ -37,6 +40,10 @@ class HistoryEmpty(Exception):
 class Plugin(_gobject.GObject):
 
     OPTIONS = {}
+    # plugins that are nothing but a widget are skipped without a display
+    WIDGET = False
+    # options naming the files a plugin keeps between runs
+    FILES = ()
 
     def __init__(self, name, options, klemmbrett):
         if hasattr(self, '_initialized'):
@@ -57,23 +64,14 @@ class Plugin(_gobject.GObject):
             text = text()
         self.klemmbrett.set(text)
 
-    def _printable(self, text, htmlsafe = False):
-        ll = int(self.options.get('line-length', 30))
-        clean = _re.sub(r'\s+', ' ', text).strip()
-
-        if len(clean) > ll:
-            om = self.options.get('omit-mode', 'middle')
-            if om == 'start':
-                clean = clean[len(clean) - ll:]
-            elif om == 'middle':
-                clean = clean[:int(ll / 2)] + " ... " + clean[len(clean) - int(ll / 2):]
-            elif om == 'end':
-                clean = clean[:ll]
-
-        if htmlsafe:
-            clean = _util.htmlsafe(clean)
+    def _preview_options(self):
+        return (
+            int(self.options.get('line-length', 30)),
+            self.options.get('omit-mode', 'middle'),
+        )
 
-        return clean
+    def _printable(self, text, htmlsafe = False):
+        return _util.printable(text, *self._preview_options(), htmlsafe = htmlsafe)
 
     def bootstrap(self):
         pass
@@ -81,6 +79,8 @@ class Plugin(_gobject.GObject):
 
 class StatusIcon(Plugin):
 
+    WIDGET = True
+
     def __init__(self, *args, **kwargs):
         super(StatusIcon, self).__init__(*args, **kwargs)
 
@@ -118,81 +118,329 @@ class StatusIcon(Plugin):
         )
 
 
+_ACCELS = list(
+    _it.chain(
+        map(str, range(0, 10)),
+        map(
+            chr,
+            _it.chain(
+                range(ord('a'), ord('z') + 1),
+                range(ord('A'), ord('Z') + 1)),
+        )
+    )
+)
+
+
+class SearchWindow(object):
+    """
+        Type to filter popup for the items of a PopupPlugin, backed by
+        the search index of the plugin
+    """
+
+    def __init__(self, plugin):
+        self.plugin = plugin
+        self._limit = int(plugin.options.get('search-results', 50))
+        self._query = ""
+        self._keys = None
+        self._fuzzy = False
+
+        self._store = _gtk.ListStore(str, _gobject.TYPE_PYOBJECT)
+        self._view = _gtk.TreeView(model = self._store)
+        self._view.set_headers_visible(False)
+        self._view.append_column(_gtk.TreeViewColumn("", _gtk.CellRendererText(), text = 0))
+        self._view.connect("row-activated", self._row_activated)
+
+        self._entry = _gtk.Entry()
+        self._entry.connect("changed", self._changed)
+        self._entry.connect("activate", self._activate)
+
+        scroller = _gtk.ScrolledWindow()
+        scroller.set_policy(_gtk.PolicyType.NEVER, _gtk.PolicyType.AUTOMATIC)
+        scroller.add(self._view)
+
+        box = _gtk.Box(orientation = _gtk.Orientation.VERTICAL)
+        box.pack_start(self._entry, False, False, 0)
+        box.pack_start(scroller, True, True, 0)
+
+        self._window = _gtk.Window()
+        self._window.set_decorated(False)
+        self._window.set_keep_above(True)
+        self._window.set_skip_taskbar_hint(True)
+        self._window.set_position(_gtk.WindowPosition.MOUSE)
+        self._window.set_default_size(
+            int(plugin.options.get('search-width', 480)),
+            int(plugin.options.get('search-height', 320)),
+        )
+        self._window.add(box)
+        self._window.connect("key-press-event", self._key_pressed)
+        self._window.connect("focus-out-event", self._hide)
+
+    def show(self):
+        self._keys = None
+        self._entry.set_text("")
+        self._changed(self._entry)
+        self._window.show_all()
+        self._window.present_with_time(self.plugin.klemmbrett.backend.event_time())
+        self._entry.grab_focus()
+
+    def _hide(self, *args):
+        self._window.hide()
+        return False
+
+    def _changed(self, entry):
+        query = entry.get_text()
+        index = self.plugin._search_index()
+        extends = self._keys is not None and query.startswith(self._query)
+
+        # narrow down the previous result while the query is only typed
+        # on, resort to fuzzy matching when nothing contains the query
+        if extends and self._fuzzy:
+            keys = index.fuzzy(query, self._keys)
+        else:
+            keys = index.search(query, self._keys if extends else None)
+            self._fuzzy = False
+            if not keys and query:
+                keys = index.fuzzy(query)
+                self._fuzzy = True
+
+        self._query = query
+        self._keys = keys
+
+        self._store.clear()
+        for label, value in self.plugin._search_items(keys, self._limit):
+            self._store.append((label, value))
+
+        if len(self._store):
+            self._view.set_cursor(_gtk.TreePath.new_first(), None, False)
+
+    def _key_pressed(self, widget, event):
+        if event.keyval == _gdk.KEY_Escape:
+            self._hide()
+            return True
+
+        if event.keyval in (_gdk.KEY_Up, _gdk.KEY_Down):
+            path, column = self._view.get_cursor()
+            if path is None or not len(self._store):
+                return True
+
+            pos = path.get_indices()[0] + (1 if event.keyval == _gdk.KEY_Down else -1)
+            pos = max(0, min(pos, len(self._store) - 1))
+            self._view.set_cursor(_gtk.TreePath.new_from_indices([pos]), None, False)
+            return True
+
+        return False
+
+    def _activate(self, entry):
+        path, column = self._view.get_cursor()
+        if path is not None:
+            self._row_activated(self._view, path, column)
+
+    def _row_activated(self, view, path, column):
+        value = self._store[path][1]
+        self._hide()
+        self.plugin.set(view, value)
+
+
 class PopupPlugin(Plugin):
 
     def bootstrap(self):
-        _keybinder.bind(
+        # the popup menu for the items of this plugin is kept around
+        # and only brought up to date when the items changed
+        self._menu = None
+        self._menu_items = []
+        self._menu_stamp = object()
+        self._search = None
+
+        self.klemmbrett.bind(
             self.options.get('shortcut', self.DEFAULT_BINDING),
             self.popup,
         )
 
-    def _expand(self, widget, iterable):
+    def _expand(self, widget, iterable, expanded):
+        """
+            Fill the submenu of widget with the first page of items, it is
+            kept until the stamp of iterable changes. Without a stamp there
+            is no telling whether the items changed, so they are read again
+            every time.
+        """
+        stamp = iterable.stamp() if hasattr(iterable, "stamp") else None
+        if expanded and stamp is not None and expanded[0] == stamp:
+            return
+
         sm = widget.get_submenu()
-        self._build_menu(sm, iterable())
+        for child in sm.get_children():
+            child.destroy()
+        self._build_page(sm, iter(iterable()))
         sm.show_all()
+        expanded[:] = [stamp]
 
-    def _build_menu(self, menu, items):
-        accels = list(
-            _it.chain(
-                range(0, 10),
-                map(
-                    chr,
-                    _it.chain(
-                        range(ord('a'), ord('z') + 1),
-                        range(ord('A'), ord('Z') + 1)),
-                )
-            )
-        )
-        for pos, (label, value) in enumerate(items):
-            try:
-                label = "_%s %s" % (accels[pos], label.replace('_', '__'))
-                item = _gtk.MenuItem(label, use_underline = True)
-            except IndexError:
-                # We ran out of accelerator keys, too bad...
-                item = _gtk.MenuItem(label, use_underline = False)
+    def _expand_page(self, widget, items):
+        sm = widget.get_submenu()
+        if sm.get_children():
+            return
+        self._build_page(sm, items)
+        sm.show_all()
 
-            if _util.isgenerator(value):
-                item.set_submenu(_gtk.Menu())
-                item.connect("activate", self._expand, value)
-            else:
-                item.connect("activate", self.set, value)
+    def _build_page(self, menu, items):
+        """ Add the next page of items to menu, followed by a submenu holding the rest """
+        size = int(self.options.get('page-size', 50))
+        self._build_menu(menu, _it.islice(items, size))
 
-            menu.append(item)
+        try:
+            rest = _it.chain((next(items),), items)
+        except StopIteration:
+            return
 
-    def _ungrab_keyboard(self):
-        dm = _gdkx11.X11DeviceManagerCore(display=_gdk.Display.get_default())
-        for dev in dm.list_devices(_gdk.DeviceType.MASTER):
-            if dev.get_source() == _gdk.InputSource.KEYBOARD:
-                dev.ungrab(_keybinder.get_current_event_time())
+        item = _gtk.MenuItem("more\u2026")
+        item.set_submenu(_gtk.Menu())
+        item.connect("activate", self._expand_page, rest)
+        menu.append(item)
 
-    def popup(self, keystr, items = None):
-        self._ungrab_keyboard()
+    def _label_item(self, item, pos, label):
+        try:
+            item.set_label("_%s %s" % (_ACCELS[pos], label.replace('_', '__')))
+            item.set_use_underline(True)
+        except IndexError:
+            # We ran out of accelerator keys, too bad...
+            item.set_label(label)
+            item.set_use_underline(False)
 
-        menu = _gtk.Menu()
-        index = 0
+    def _bind_item(self, item, value):
+        if _util.isgenerator(value):
+            item.set_submenu(_gtk.Menu())
+            return item.connect("activate", self._expand, value, [])
 
-        if _util.humanbool(self.options.get('show-current-selection', 'yes')) and len(self.history):
-            item = _gtk.MenuItem("")
-            item.get_children()[0].set_markup(
-                "<b>%s</b>" % (self._printable(self.history.top, True),),
-            )
+        item.set_submenu(None)
+        return item.connect("activate", self.set, value)
+
+    def _build_menu(self, menu, items):
+        for pos, (label, value) in enumerate(items):
+            item = _gtk.MenuItem()
+            self._label_item(item, pos, label)
+            self._bind_item(item, value)
             menu.append(item)
-            menu.append(_gtk.SeparatorMenuItem())
-            index += 1
 
-        self._build_menu(menu, items or self.items())
+    def _items_stamp(self):
+        """ Changes whenever the items of this plugin change """
+        return None
 
-        menu.show_all()
-        menu.popup(
-            None,
-            None,
-            None,
-            None,
-            0,
-            _keybinder.get_current_event_time(),
+    def set(self, widget = None, text = None):
+        # values from a history know how to load their text again, so it
+        # does not have to be kept in memory while it is in the clipboard
+        source = getattr(text, "source", None)
+        if callable(text):
+            try:
+                text = text()
+            except _storage.MissingBlob:
+                _log.error("Could not load item of plugin %r", self.name, exc_info = True)
+                self.klemmbrett.notify("Klemmbrett", "The item is not available any more")
+                return
+        if text is None:
+            # nothing to set, e.g. the item only has a side effect
+            return
+        if isinstance(text, str):
+            self.history.touch(text)
+        self.klemmbrett.set(text, source = source)
+
+    def _prepare_menu(self):
+        """ Bring the prebuilt popup menu up to date with the items """
+        if self._menu is None:
+            self._menu = _gtk.Menu()
+            self._header = _gtk.MenuItem("")
+            self._separator = _gtk.SeparatorMenuItem()
+            self._menu.append(self._header)
+            self._menu.append(self._separator)
+
+        stamp = self._items_stamp()
+        if stamp == self._menu_stamp:
+            return self._menu
+        self._menu_stamp = stamp
+
+        # reuse the existing menu items by label, only their position,
+        # accelerator and activation handler are updated
+        unused = _collections.defaultdict(_collections.deque)
+        for label, item, handler in self._menu_items:
+            unused[label].append((item, handler))
+
+        entries = []
+        for pos, (label, value) in enumerate(self.items()):
+            try:
+                item, handler = unused[label].popleft()
+                item.disconnect(handler)
+            except IndexError:
+                item = _gtk.MenuItem()
+                self._menu.append(item)
+
+            self._label_item(item, pos, label)
+            handler = self._bind_item(item, value)
+            self._menu.reorder_child(item, pos + 2)
+            item.show()
+            entries.append((label, item, handler))
+
+        for items in unused.values():
+            for item, handler in items:
+                item.destroy()
+
+        self._menu_items = entries
+        return self._menu
+
+    def _prepare_header(self):
+        if not (
+            _util.humanbool(self.options.get('show-current-selection', 'yes'))
+            and len(self.history)
+        ):
+            self._header.hide()
+            self._separator.hide()
+            return 0
+
+        self._header.get_children()[0].set_markup(
+            "<b>%s</b>" % (
+                self.history.preview(
+                    self.history.top_entry,
+                    *self._preview_options(),
+                    htmlsafe = True
+                ),
+            ),
         )
-        menu.set_active(index)
-        return True
+        self._header.show()
+        self._separator.show()
+        return 1
+
+    def _search_index(self):
+        """ The search.TrigramIndex over the items, None if searching is not supported """
+        return None
+
+    def _search_items(self, keys, limit):
+        """ Return up to limit of the items with the given search keys """
+        return []
+
+    def menu(self, items = None):
+        """
+            Return the popup menu of this plugin, or one for items, and the
+            position of the item to preselect in it
+        """
+        if items is not None:
+            menu = _gtk.Menu()
+            self._build_menu(menu, items)
+            menu.show_all()
+            return menu, 0
+
+        menu = self._prepare_menu()
+        return menu, self._prepare_header()
+
+    def popup(self, keystr, items = None):
+        backend = self.klemmbrett.backend
+        backend.ungrab_keyboard()
+
+        if items is None and backend.DISPLAY and self.options.get('popup-mode', 'menu') == 'search':
+            if self._search_index() is not None:
+                if self._search is None:
+                    self._search = SearchWindow(self)
+                self._search.show()
+                return True
+            _log.warning("Plugin %r does not support searching, showing a menu", self.name)
+
+        return backend.popup(self, items)
 
 
 class FancyItemsMixin(object):
@@ -201,6 +449,15 @@ class FancyItemsMixin(object):
     _TYPE_SEPERATOR = "."
 
     def bootstrap(self):
+        self._resolve_cache = dict()
+        self._shortcuts = []
+        self._load_items()
+
+    def reload(self):
+        """ Pick up changed items after the configuration has been read again """
+        self._load_items()
+
+    def _load_items(self):
         self._items = []
         section = self.options.get('simple-section', self.SIMPLE_SECTION)
         default_type = self.options.get('simple-section-default', self.SIMPLE_SECTION_DEFAULT)
@@ -226,14 +483,201 @@ class FancyItemsMixin(object):
 
             self._items.append((label, options))
 
+        self._resolve_items()
+
+    def _resolve_items(self):
+        """
+            Resolve the value of every item once. Values are cached by the
+            label and options of their item, so only items whose config
+            section changed are resolved again on a reload.
+        """
+        for shortcut in self._shortcuts:
+            self.klemmbrett.unbind(shortcut)
+        self._shortcuts = []
+
+        slow = float(self.options.get('slow-resolve', 50)) / 1000
+        cache, self._resolve_cache = self._resolve_cache, dict()
+        items = []
+        resolved = []
+        self.resolve_times = dict()
+
+        for label, options in self._items:
+            key = (label, tuple(sorted(options.items())))
+            try:
+                value = cache[key]
+            except KeyError:
+                start = _time.perf_counter()
+                try:
+                    value = self._resolve(label, options)
+                except Exception:
+                    # a broken item must not take the others down with it
+                    _log.error("Could not set up item %r of plugin %r", label, self.name, exc_info = True)
+                    self.klemmbrett.notify("Klemmbrett", "%s could not be set up, see the log" % (label,))
+                    continue
+                self.resolve_times[label] = _time.perf_counter() - start
+
+                if self.resolve_times[label] > slow:
+                    _log.warning(
+                        "Resolving item %r of plugin %r took %.1fms",
+                        label,
+                        self.name,
+                        self.resolve_times[label] * 1000,
+                    )
+
+            self._resolve_cache[key] = value
+            items.append((label, options))
+            resolved.append((label, value))
+
             if "shortcut" in options:
-                _keybinder.bind(
-                    options['shortcut'],
-                    _ft.partial(self.set, widget = None, text = label),
-                )
+                self.klemmbrett.bind(options['shortcut'], self._shortcut_pressed, value)
+                self._shortcuts.append(options['shortcut'])
+
+        # only the items that could be set up are shown
+        self._items = items
+        self._resolved = resolved
+
+    def _resolve(self, label, options):
+        """ Turn the options of an item into the value shown in the popup """
+        return options
+
+    def _shortcut_pressed(self, keystr, value):
+        self.set(None, value)
+
+    def slow_items(self):
+        """ Report the items which took longer than slow-resolve ms to resolve, slowest first """
+        slow = float(self.options.get('slow-resolve', 50)) / 1000
+        return sorted(
+            ((label, took) for label, took in self.resolve_times.items() if took > slow),
+            key = lambda item: item[1],
+            reverse = True,
+        )
 
     def items(self):
-        return iter(self._items)
+        return iter(self._resolved)
+
+
+class HistoryEntry(object):
+    """
+        A single history item along with what the controller knows about it.
+        Payloads handed a blob store are kept on disk, compressed payloads
+        are kept as bytes, both are only restored when the text is asked for.
+    """
+
+    __slots__ = (
+        "_payload", "_store", "_codec",
+        "digest", "size", "length", "packed", "excerpt", "previews", "score", "rank", "pinned", "rich",
+    )
+
+    def __init__(self, text, digest, size, store = None):
+        self.digest = digest
+        self.size = size
+        # in characters, to tell texts apart without loading the payload
+        self.length = len(text)
+        # decayed use count in log space, see HistoryController._touch
+        self.score = None
+        # key of the entry in the ranking of HistoryController, if any
+        self.rank = None
+        self.pinned = False
+        # raw head and tail of long texts, enough to build previews from
+        self.excerpt = None
+        # previews by (line-length, omit-mode, htmlsafe)
+        self.previews = dict()
+        self.packed = None
+        # descriptor of the image or markup the text stands in for
+        self.rich = None
+        self._store = store
+        self._codec = None
+        self._payload = text if store is None else None
+
+    @property
+    def text(self):
+        if self._store is not None:
+            return self._store.get(self.digest)
+        if self._codec is not None:
+            return self._codec.decompress(self._payload).decode("utf-8", "surrogatepass")
+        return self._payload
+
+    @property
+    def compressed(self):
+        return self._codec is not None
+
+    @property
+    def stored(self):
+        return self._store is not None
+
+    def compress(self, codec):
+        """ Replace the text by its compressed form, if that actually saves space """
+        if self._store is not None or self._codec is not None:
+            return False
+
+        packed = codec.compress(_util.encode(self._payload))
+        if len(packed) >= self.size:
+            return False
+
+        self._payload = packed
+        self._codec = codec
+        self.packed = len(packed)
+        return True
+
+    def inflate(self, text):
+        """ Keep text, which is known to be the payload, uncompressed again """
+        self._payload = text
+        self._codec = None
+        self.packed = None
+
+    def freeze(self):
+        """ Return a copy of the entry, unaffected by later compression or inflation of it """
+        frozen = HistoryEntry.__new__(HistoryEntry)
+        for slot in self.__slots__:
+            setattr(frozen, slot, getattr(self, slot))
+        return frozen
+
+    def discard(self):
+        if self._store is not None:
+            self._store.remove(self.digest)
+        if self.rich is not None:
+            self.rich.discard()
+
+
+class HistorySnapshot(object):
+    """
+        The entries of a history at one point in time. It can be read from
+        other threads while the history itself keeps changing.
+    """
+
+    def __init__(self, entries, blobs = None):
+        # newest first
+        self._entries = entries
+        # the blobs of the entries stay around until the snapshot is released
+        self._blobs = blobs
+        self._pinned = [entry.digest for entry in entries if entry.stored] if blobs is not None else []
+        if self._pinned:
+            blobs.pin(self._pinned)
+
+    def release(self):
+        """ Let go of the blobs, the snapshot must not be read any more """
+        if self._pinned:
+            self._blobs.unpin(self._pinned)
+            self._pinned = []
+
+    def __iter__(self):
+        return (entry.text for entry in self._entries)
+
+    def entries(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def top(self):
+        return self.top_entry.text
+
+    @property
+    def top_entry(self):
+        if not self._entries:
+            raise HistoryEmpty("The history is empty")
+        return self._entries[0]
 
 
 class HistoryController(Plugin):
@@ -242,47 +686,451 @@ class HistoryController(Plugin):
         "text-accepted": (_gobject.SIGNAL_RUN_FIRST, None, (_gobject.TYPE_PYOBJECT,)),
     }
 
+    _CODECS = {
+        "none": None,
+        "zlib": _zlib,
+        "lzma": _lzma,
+    }
+
+    _PIN_MARK = "\u2605 "
+
     def __init__(self, name, options, klemmbrett):
         Plugin.__init__(self, name, options, klemmbrett)
-        self._history = _collections.deque(maxlen = self.maxlen)
+        # entries indexed by their content hash, the newest entry comes last
+        self._history = _collections.OrderedDict()
+        # total payload size of all entries in bytes
+        self._bytes = 0
+        # counts every change of the entries or their order
+        self.generation = 0
         self._extend_detection = _util.humanbool(self.options.get('extend-detection', 'yes'))
+        self._extend_window = int(self.options.get('extend-window', 64))
+        self._fingerprint = None
+        self._excerpt = int(self.options.get('preview-excerpt', 256))
+        self._index = None
+
+        # entries larger than blob-threshold are moved out of memory
+        self._blob_threshold = _util.bytesize(self.options.get('blob-threshold', '1M'))
+        self._blobs = None
+        if self._blob_threshold:
+            # blobs only back the in memory history, every process keeps
+            # them apart from those of others
+            self._blobs = _storage.BlobStore.private(
+                _os.path.expanduser(self.options.get('blob-store', '~/.klemmbrett.blobs')),
+                "%s-" % (self.name,),
+            )
+
+        # entries beyond the hot-entries newest ones are compressed, a
+        # few of them are kept decompressed after they have been accessed
+        self._codec = self._CODECS[self.options.get('compression', 'zlib')]
+        self._hot = int(self.options.get('hot-entries', 5))
+        self._compress_min = _util.bytesize(self.options.get('compress-min-size', 512))
+        self._inflated = _collections.OrderedDict()
+        self._inflated_max = int(self.options.get('compression-cache', 4))
+        self._packed = 0
+        self._packed_bytes = 0
+
+        # with frecency ranking entries are ordered by their uses, each
+        # decaying with the given half-life, and the lowest ranked entry is
+        # evicted first. ranks are kept in a heap, a use pushes a new rank
+        # and leaves the old one behind to be skipped, so it takes
+        # O(log n).
+        self._frecency = self.options.get('ranking', 'recency') == 'frecency'
+        self._decay = _math.log(2) / (float(self.options.get('half-life', 72)) * 3600)
+        self._ranks = []
+        self._rank_seq = _it.count()
+        self._touched = None
+        self._touched_at = 0
 
     def items(self):
-        for text in self._history:
+        for entry in self._ranked():
             yield (
-                self._printable(text),
-                text,
+                (self._PIN_MARK if entry.pinned else "") + self.preview(entry, *self._preview_options()),
+                self._value(entry),
             )
 
+    def _value(self, entry):
+        if entry.rich is None:
+            value = _ft.partial(self._text, entry)
+            value.source = self._source(entry)
+            return value
+
+        value = _ft.partial(self.klemmbrett.set_rich, entry.rich)
+        value.rich = entry.rich
+        return value
+
+    def _ranked(self):
+        if not self._frecency:
+            return reversed(self._history.values())
+        return iter(sorted(
+            (entry for entry in self._history.values() if entry.rank is not None),
+            key = lambda entry: entry.rank,
+            reverse = True,
+        ))
+
+    def touch(self, text):
+        """ Count a use of text, if it is in the history """
+        entry = self._history.get(_util.digest(text))
+        if entry is not None:
+            self._touch(entry)
+            self.generation += 1
+
+    def _touch(self, entry):
+        # a menu activation is followed by the text coming back through
+        # add, which must not count as a second use
+        now = _time.time()
+        if (
+            entry.score is not None
+            and self._touched == entry.digest
+            and now - self._touched_at < 1
+        ):
+            return
+        self._touched, self._touched_at = entry.digest, now
+
+        # the score is log(sum(exp(decay * t))) over all uses t, which keeps
+        # the order of entries stable as time passes, so ranks only change
+        # when an entry is used
+        now *= self._decay
+        if entry.score is None:
+            entry.score = now
+        else:
+            high, low = max(entry.score, now), min(entry.score, now)
+            entry.score = high + _math.log1p(_math.exp(low - high))
+
+        if self._frecency:
+            self._rank(entry)
+
+    def _rank(self, entry):
+        entry.rank = (entry.score, next(self._rank_seq), entry.digest)
+        _heapq.heappush(self._ranks, entry.rank)
+
+        # outdated ranks stay in the heap until they come up, it is only
+        # rebuilt once they make up most of it
+        if len(self._ranks) > 2 * len(self._history) + 16:
+            self._ranks = [entry.rank for entry in self._history.values() if entry.rank is not None]
+            _heapq.heapify(self._ranks)
+
+    def _unrank(self, entry):
+        entry.rank = None
+
+    def _ranked_entry(self, rank):
+        """ Return the entry rank belongs to, None if the rank is outdated """
+        entry = self._history.get(rank[2])
+        if entry is None or entry.rank is not rank:
+            return None
+        return entry
+
+    def pin(self, pinned = None, entry = None):
+        """ Toggle or set whether entry, by default the top one, is exempt from eviction """
+        if entry is None:
+            entry = self.top_entry
+        entry.pinned = (not entry.pinned) if pinned is None else pinned
+        self.generation += 1
+        return entry.pinned
+
+    def enable_index(self):
+        """ Start maintaining a search index over the history """
+        if self._index is not None:
+            return self._index
+
+        self._index = _search.TrigramIndex(int(self.options.get('search-index-chars', 1024)))
+        for entry in self._history.values():
+            self._index.add(entry.digest, self._text(entry))
+        return self._index
+
+    def preview(self, entry, line_length, omit_mode, htmlsafe = False, text = None):
+        """
+            Return the cached preview of entry, build it from the excerpt
+            of the entry or, if that is not enough, its whole text
+        """
+        key = (line_length, omit_mode, htmlsafe)
+        try:
+            return entry.previews[key]
+        except KeyError:
+            pass
+
+        clean = None
+        if entry.excerpt is not None:
+            clean = _util.printable_ends(entry.excerpt[0], entry.excerpt[1], line_length, omit_mode)
+            if clean is not None and htmlsafe:
+                clean = _util.htmlsafe(clean)
+
+        if clean is None:
+            if text is None:
+                text = self._text(entry)
+            clean = _util.printable(text, line_length, omit_mode, htmlsafe)
+
+        entry.previews[key] = clean
+        return clean
+
     def is_extended(self, text):
-        if not self._extend_detection:
+        if not self._extend_detection or not self._history:
+            return False
+
+        # compare the cheap fingerprint of the top entry against the
+        # regions of text it would occupy, before comparing the digest of
+        # such a region with that of the top entry, which, unlike its
+        # text, needs no loading from the blob store or decompressing
+        length, head, tail = self._fingerprint
+        if len(text) <= length:
             return False
 
+        window = min(self._extend_window, length)
+
         if (
-            len(self)
-            and (
-                text.startswith(self.top)
-                or text.endswith(self.top)
-            )
+            hash(text[:window]) == head
+            and hash(text[length - window:length]) == tail
+            and _util.digest(text[:length]) == self.top_entry.digest
         ):
+            return True
 
+        offset = len(text) - length
+        if (
+            hash(text[offset:offset + window]) == head
+            and hash(text[len(text) - window:]) == tail
+            and _util.digest(text[offset:]) == self.top_entry.digest
+        ):
             return True
+
         return False
 
-    def add(self, text, emit = True):
-        if self.accepts(text):
-            if self.is_extended(text):
-                self._history[0] = text
+    def _fingerprint_top(self, top):
+        """ Remember where to look for top, the text of the top entry, in extended texts """
+        window = min(self._extend_window, len(top))
+        self._fingerprint = (
+            len(top),
+            hash(top[:window]),
+            hash(top[len(top) - window:]),
+        )
+
+    def add(self, text, emit = True, rich = None):
+        """ Add text, rich optionally describes markup that was copied along with it """
+        if not self.accepts(text):
+            if rich is not None:
+                # the text is known already, it may come with markup now
+                entry = self._history.get(_util.digest(text))
+                if entry is not None:
+                    self._attach(entry, rich)
+            return False
+
+        replaced = None
+        if self.is_extended(text):
+            replaced = self._history.popitem()[1]
+            self._drop(replaced)
+
+        data = _util.encode(text)
+        key = _util.digest(data)
+        if key in self._history:
+            # a known entry is copied again, move it to the front
+            self._history.move_to_end(key)
+            entry = self._history[key]
+            if entry.compressed:
+                self._forget(entry)
+                entry.inflate(text)
+        else:
+            entry = self._entry(text, data, key)
+            if replaced is not None:
+                entry.score, entry.pinned = replaced.score, replaced.pinned
+            self._history[entry.digest] = entry
+            if self._index is not None:
+                self._index.add(entry.digest, text)
+            self._bytes += entry.size
+
+        if replaced is None:
+            self._touch(entry)
+        elif self._frecency:
+            # an extended selection is still the same use
+            self._rank(entry)
+        if rich is not None:
+            self._attach(entry, rich)
+        self._evict()
+
+        self._compress()
+        # the top entry is the one that was just added, no need to
+        # read it back from where it is kept now
+        self._fingerprint_top(text)
+        self.generation += 1
+
+        if emit:
+            self.emit("text-accepted", text)
+        return True
+
+    def _attach(self, entry, rich):
+        """ Let entry take a reference to rich, dropping what it held before """
+        if entry.rich is not None and entry.rich.digest == rich.digest:
+            # the same contents again, the reference held is enough
+            return
+        rich.retain()
+        if entry.rich is not None:
+            entry.rich.discard()
+        entry.rich = rich
+        self.generation += 1
+
+    def add_rich(self, clip):
+        """ Add the descriptor of an image, which comes without text, keyed by its contents """
+        if clip.digest in self._history:
+            self._history.move_to_end(clip.digest)
+            entry = self._history[clip.digest]
+            self._attach(entry, clip)
+            self._touch(entry)
+        else:
+            entry = self._entry(clip.text, _util.encode(clip.text), clip.digest)
+            clip.retain()
+            entry.rich = clip
+            self._history[entry.digest] = entry
+            if self._index is not None:
+                self._index.add(entry.digest, clip.text)
+            self._bytes += entry.size
+            self._touch(entry)
+
+        self._evict()
+        self._compress()
+        self._fingerprint_top(clip.text)
+        self.generation += 1
+        return True
+
+    def _entry(self, text, data, digest):
+        store = None
+        if self._blobs is not None and len(data) > self._blob_threshold:
+            store = self._blobs
+            store.put(digest, data)
+
+        entry = HistoryEntry(text, digest, len(data), store)
+        if len(text) > 2 * self._excerpt:
+            entry.excerpt = (text[:self._excerpt], text[len(text) - self._excerpt:])
+        self.preview(entry, *self._preview_options(), text = text)
+        return entry
+
+    def _drop(self, entry):
+        if self._index is not None:
+            self._index.remove(entry.digest)
+        self._bytes -= entry.size
+        self._forget(entry)
+        self._unrank(entry)
+        entry.discard()
+
+    def _compress(self):
+        # everything newer was hot before, so only the entry that just
+        # slipped out of the hot ones can be left to compress
+        if self._codec is None:
+            return
+
+        for entry in _it.islice(reversed(self._history.values()), self._hot, self._hot + 1):
+            if entry.size >= self._compress_min and entry.compress(self._codec):
+                self._packed += entry.size
+                self._packed_bytes += entry.packed
+
+    def _forget(self, entry):
+        self._inflated.pop(entry.digest, None)
+        if entry.compressed:
+            self._packed -= entry.size
+            self._packed_bytes -= entry.packed
+
+    def _source(self, entry):
+        """
+            Return a function loading the text of entry. The entry, and its
+            blob, is kept for as long as the function is, even if it left
+            the history meanwhile, e.g. while the text is offered.
+        """
+        source = _ft.partial(self._load, entry)
+        if entry.stored:
+            self._blobs.pin([entry.digest])
+            _weakref.finalize(source, self._blobs.unpin, [entry.digest])
+        return source
+
+    def _load(self, entry):
+        try:
+            if self._history.get(entry.digest) is entry:
+                return self._text(entry)
+            return entry.text
+        except _storage.MissingBlob:
+            _log.error("Could not load history entry", exc_info = True)
+            return None
+
+    def _text(self, entry):
+        if not entry.compressed:
+            return entry.text
+
+        try:
+            self._inflated.move_to_end(entry.digest)
+            return self._inflated[entry.digest]
+        except KeyError:
+            pass
+
+        text = self._inflated[entry.digest] = entry.text
+        while len(self._inflated) > self._inflated_max:
+            self._inflated.popitem(last = False)
+        return text
+
+    def _evict(self):
+        # the newest entry is kept even if it exceeds the byte budget on its own
+        max_bytes = self.max_bytes
+        while len(self._history) > 1 and (
+            len(self._history) > self.maxlen
+            or (max_bytes and self._bytes > max_bytes)
+        ):
+            entry = self._victim()
+            if entry is None:
+                break
+            del self._history[entry.digest]
+            self._drop(entry)
+
+    def _victim(self):
+        """ Return the entry to evict next, pinned entries and the top one are spared """
+        top = self.top_entry
+
+        if not self._frecency:
+            for entry in self._history.values():
+                if entry is top:
+                    return None
+                if not entry.pinned:
+                    return entry
+            return None
+
+        victim = None
+        spared = []
+        while self._ranks:
+            entry = self._ranked_entry(self._ranks[0])
+            if entry is None:
+                _heapq.heappop(self._ranks)
+            elif entry is top or entry.pinned:
+                spared.append(_heapq.heappop(self._ranks))
             else:
-                self._history.appendleft(text)
+                victim = entry
+                break
 
-            if emit:
-                self.emit("text-accepted", text)
-            return True
-        return False
+        for rank in spared:
+            _heapq.heappush(self._ranks, rank)
+        return victim
+
+    def usage(self):
+        """ Report the number of entries and payload bytes held by the history """
+        return {
+            "entries": len(self._history),
+            "length": self.maxlen,
+            "bytes": self._bytes,
+            "max-bytes": self.max_bytes,
+            "compressed-entries": sum(1 for entry in self._history.values() if entry.compressed),
+            "compressed-bytes": self._packed_bytes,
+            "compression-ratio": (self._packed_bytes / self._packed) if self._packed else 1.0,
+            "bytes-saved": self._packed - self._packed_bytes,
+        }
+
+    def snapshot(self):
+        """ Return a HistorySnapshot of the entries, to be read from another thread """
+        return HistorySnapshot(
+            [entry.freeze() for entry in reversed(self._history.values())],
+            self._blobs,
+        )
 
     def __iter__(self):
-        return iter(self._history)
+        return (self._text(entry) for entry in reversed(self._history.values()))
+
+    def entries(self):
+        """ The entries, newest first, to look at their digests without loading their texts """
+        return reversed(self._history.values())
+
+    def __contains__(self, text):
+        return _util.digest(text) in self._history
 
     def __len__(self):
         return len(self._history)
@@ -301,19 +1149,30 @@ class HistoryController(Plugin):
         if not len(self._history):
             return True
 
-        # only if it is not the current selection
+        # only if it is not the current selection, which is only loaded
+        # when it could actually be the same
+        if len(text) != self.top_entry.length:
+            return True
         return text != self.top
 
     @property
     def top(self):
+        return self._text(self.top_entry)
+
+    @property
+    def top_entry(self):
         if not self._history:
             raise HistoryEmpty("The history is empty")
-        return self._history[0]
+        return next(reversed(self._history.values()))
 
     @property
     def maxlen(self):
         return int(self.options.get("length", 15))
 
+    @property
+    def max_bytes(self):
+        return _util.bytesize(self.options.get("max-bytes", 0))
+
 
 class HistoryPicker(HistoryController, PopupPlugin):
 
@@ -330,13 +1189,74 @@ class HistoryPicker(HistoryController, PopupPlugin):
     def bootstrap(self):
         PopupPlugin.bootstrap(self)
         HistoryController.bootstrap(self)
+        if self.options.get('popup-mode', 'menu') == 'search':
+            self.enable_index()
+        if 'pin-shortcut' in self.options:
+            self.klemmbrett.bind(self.options['pin-shortcut'], self._pin_top)
         self.klemmbrett.connect("text-selected", self._text_selected)
+        self.klemmbrett.connect("rich-selected", self._rich_selected)
+        self.connect("text-accepted", self._text_accepted)
 
     def _text_selected(self, widget, text):
-        return self.add(text)
+        return self.add(text, rich = self.klemmbrett.rich_selection)
+
+    def _rich_selected(self, widget, clip):
+        self.add_rich(clip)
+        self._prebuild_menu()
+        return True
+
+    def _bind_item(self, item, value):
+        # images show a thumbnail when hovered, it is only made then
+        rich = getattr(value, "rich", None)
+        item.set_has_tooltip(rich is not None and rich.image)
+        if not hasattr(item, "rich"):
+            item.connect("query-tooltip", self._query_tooltip)
+        item.rich = rich
+        return PopupPlugin._bind_item(self, item, value)
+
+    def _query_tooltip(self, item, x, y, keyboard, tooltip):
+        if item.rich is None or not item.rich.image:
+            return False
+        tooltip.set_icon(item.rich.thumbnail(int(self.options.get('thumbnail-size', 128))))
+        return True
+
+    def _pin_top(self, keystr):
+        if not len(self):
+            return
+        pinned = self.pin()
+        self.klemmbrett.notify(
+            "Pinned" if pinned else "Unpinned",
+            self.preview(self.top_entry, *self._preview_options(), htmlsafe = True),
+        )
+        self._prebuild_menu()
+
+    def _text_accepted(self, widget, text):
+        self._prebuild_menu()
+
+    def _prebuild_menu(self):
+        # keep the popup ready, so the shortcut only has to show it
+        if self.klemmbrett.backend.DISPLAY:
+            self._prepare_menu()
+
+    def _items_stamp(self):
+        return self.generation
+
+    def _search_index(self):
+        return self.enable_index()
+
+    def _search_items(self, keys, limit):
+        entries = (entry for entry in reversed(self._history.values()) if entry.digest in keys)
+        return [
+            (
+                self.preview(entry, *self._preview_options()),
+                self._value(entry),
+            )
+            for entry in _it.islice(entries, limit)
+        ]
 
 
 class PersistentHistory(Plugin):
+    FILES = ("histfile",)
     OPTIONS = {
         "tie:history": "history",
     }
@@ -344,35 +1264,41 @@ class PersistentHistory(Plugin):
     def __init__(self, *args, **kwargs):
         super(PersistentHistory, self).__init__(*args, **kwargs)
         self._histfile = _os.path.expanduser(self.options.get("histfile", "~/.klemmbrett.history"))
+        self._compact_threshold = int(self.options.get("compact-threshold", 100))
+        self._log = _storage.HistoryLog(self._histfile)
 
     def bootstrap(self):
         self._load()
-        self._persist = open(self._histfile, "ba")
         self.history.connect("text-accepted", self._text_accepted)
 
     def _load(self):
-        if not _os.path.exists(self._histfile):
-            return
-
-        history = open(self._histfile, "br")
-        dq = _collections.deque(maxlen = self.history.maxlen)
-
-        while True:
-            try:
-                dq.append(_pickle.load(history))
-            except EOFError:
-                break
-
-        history.close()
-
-        for i in dq:
-            self.history.add(i, False)
+        # texts copied again are logged again, only their newest record counts
+        for text in self._log.open(self.history.maxlen, key = _util.digest):
+            self.history.add(text, False)
+
+        self._compact()
+
+    def _compact(self):
+        # an unknown number of dead records means we only read the tail of
+        # a log that was written before, so it is worth rewriting once
+        dead = self._log.dead(self.history.maxlen)
+        if dead is None or dead > self._compact_threshold:
+            # the log is rewritten from what the history holds, the texts
+            # are read in the background from a snapshot of it
+            snapshot = self.history.snapshot()
+            self._log.compact(_ft.partial(self._records, snapshot), snapshot.release)
+
+    def _records(self, snapshot):
+        """ The texts of snapshot that were logged, oldest first """
+        return [
+            entry.text
+            for entry in reversed(list(snapshot.entries()))
+            if entry.rich is None or not entry.rich.image
+        ]
 
     def _text_accepted(self, widget, text):
-        # FIXME(mbra): we need to handle a history size limit, so the file does
-        # not grow indefinitely
-        _pickle.dump(text, self._persist, protocol = _pickle.HIGHEST_PROTOCOL)
-        self._persist.flush()
+        self._log.append(text)
+        self._compact()
         return True
 
 
@@ -383,25 +1309,64 @@ class MultiPicker(PopupPlugin, FancyItemsMixin):
         "tie:history": "history"
     }
 
+    # the history snapshot of the job a worker thread is running
+    _worker = _threading.local()
+
+    @property
+    def history(self):
+        """ The tied history, or a snapshot of it when read from a worker thread """
+        plugin, snapshot = getattr(self._worker, "job", (None, None))
+        if plugin is self:
+            return snapshot
+        return self._tied_history
+
+    @history.setter
+    def history(self, history):
+        self._tied_history = history
+
     def bootstrap(self):
-        PopupPlugin.bootstrap(self)
-        FancyItemsMixin.bootstrap(self)
         self._types = (
             ("value", self._value),
             ("callable", self._callable),
             ("action", self._action),
             ("notify", self._notify),
+            ("cache-size", self._cached),
+            ("async", self._async),
         )
+        # hits and misses of the result cache per item
+        self.cache_stats = _collections.defaultdict(_collections.Counter)
+        self._index = None
+        self._pool = None
+        # jobs given up on while they were running, they still occupy a worker
+        self._stuck = set()
+        self._running = dict()
+        PopupPlugin.bootstrap(self)
+        FancyItemsMixin.bootstrap(self)
 
-    def items(self):
-        for label, options in FancyItemsMixin.items(self):
-            callable = lambda: self.history.top
+    def reload(self):
+        FancyItemsMixin.reload(self)
+        self._index = None
+        self._menu_stamp = object()
+
+    def _search_index(self):
+        if self._index is None:
+            self._index = _search.TrigramIndex()
+            for pos, (label, options) in enumerate(self._items):
+                self._index.add(pos, " ".join([label] + list(options.values())))
+        return self._index
 
-            for type, handler in self._types:
-                if type in options:
-                    callable = handler(label, options, callable)
+    def _search_items(self, keys, limit):
+        items = (item for pos, item in enumerate(self.items()) if pos in keys)
+        return list(_it.islice(items, limit))
 
-            yield (label, callable)
+    def _resolve(self, label, options):
+        callable = lambda: self.history.top
+
+        for type, handler in self._types:
+            if type in options:
+                callable = handler(label, options, callable)
+
+        return callable
 
     def _value(self, label, options, callable):
         return _ft.partial(options.get, "value")
@@ -415,8 +1380,25 @@ class MultiPicker(PopupPlugin, FancyItemsMixin):
 
 
     def _action(self, label, options, callable):
+        input = options.get("action-input", "argv")
+        if input != "argv" and input not in _process.Process.INPUTS:
+            raise ValueError("Unknown action-input %r of item %r" % (input, label))
+        output = options.get("action-output", "none")
+        if output not in ("none", "clipboard", "notify"):
+            raise ValueError("Unknown action-output %r of item %r" % (output, label))
+
+        # commands run without a shell are split once, right here
+        argv = None
+        if input != "argv":
+            try:
+                argv = _shlex.split(options["action"])
+            except ValueError as e:
+                raise ValueError("Cannot split action %r of item %r: %s" % (options["action"], label, e))
+            if not argv:
+                raise ValueError("Empty action of item %r" % (label,))
+
         try:
-            return _ft.partial(self._perform_action, options, callable)
+            return _ft.partial(self._perform_action, options, argv, callable)
         except HistoryEmpty:
             _log.info("History is empty")
             self.klemmbrett.notify("The history is empty", "The history is empty")
@@ -424,13 +1406,181 @@ class MultiPicker(PopupPlugin, FancyItemsMixin):
     def _notify(self, label, options, callable):
         return _ft.partial(self.klemmbrett.notify, "Klemmbrett", options.get("notify"))
 
-    @staticmethod
-    def _perform_action(options, callable):
-        _gobject.spawn_async([
-            "/bin/bash",
-            "-c",
-            options["action"] % (callable(),),
-        ]),
+    def _cached(self, label, options, callable):
+        """
+            Remember up to cache-size results of callable, optionally only
+            for cache-ttl seconds, keyed by the content of the current
+            clipboard they were produced from. Callables reading more than
+            that tell what their results depend on with a cache_key function.
+        """
+        size = int(options["cache-size"])
+        ttl = float(options.get("cache-ttl", 0))
+        if size <= 0:
+            return callable
+
+        cache = _collections.OrderedDict()
+        lock = _threading.Lock()
+        stats = self.cache_stats[label]
+        cache_key = getattr(callable, "cache_key", None)
+
+        def cached():
+            try:
+                key = cache_key() if cache_key is not None else self.history.top_entry.digest
+            except HistoryEmpty:
+                key = None
+
+            with lock:
+                hit = cache.get(key)
+                if hit is not None and (not ttl or hit[0] > _time.time()):
+                    cache.move_to_end(key)
+                    stats["hits"] += 1
+                    return hit[1]
+                stats["misses"] += 1
+
+            result = callable()
+
+            with lock:
+                cache[key] = (_time.time() + ttl, result)
+                cache.move_to_end(key)
+                while len(cache) > size:
+                    cache.popitem(last = False)
+            return result
+
+        return cached
+
+    def _async(self, label, options, callable):
+        if not _util.humanbool(options["async"]):
+            return callable
+        return _ft.partial(self._run_async, label, float(options.get("timeout", 30)), callable)
+
+    def _run_async(self, label, timeout, callable):
+        """
+            Run callable in the worker pool, its result is set on the main
+            loop once it is done. Running the item again supersedes the
+            previous run, which, like a run timing out, is cancelled if it
+            did not start yet and has its result ignored otherwise.
+        """
+        self._cancel(label)
+
+        workers = int(self.options.get('workers', 2))
+        self._stuck = set(job for job in self._stuck if not job.done())
+        if self._pool is not None and len(self._stuck) >= workers:
+            # every worker hangs in a job given up on, leave them to it
+            # and hand new jobs to a fresh pool
+            _log.warning("All workers of plugin %r are stuck, starting new ones", self.name)
+            self._pool.shutdown(wait = False)
+            self._pool = None
+            self._stuck = set()
+
+        if self._pool is None:
+            self._pool = _futures.ThreadPoolExecutor(
+                max_workers = workers,
+                thread_name_prefix = "klemmbrett-%s" % (self.name,),
+            )
+
+        # the history keeps changing on the main loop, the job only gets to
+        # see how it was when the job was started
+        snapshot = self.history.snapshot()
+        job = self._pool.submit(self._run_job, snapshot, callable)
+        timer = _glib.timeout_add(int(timeout * 1000), self._timed_out, label, job)
+        self._running[label] = (job, timer)
+        job.add_done_callback(_ft.partial(self._job_done, label, snapshot))
+        return None
+
+    def _run_job(self, snapshot, callable):
+        self._worker.job = (self, snapshot)
+        try:
+            return callable()
+        finally:
+            del self._worker.job
+
+    def _job_done(self, label, snapshot, job):
+        # the job finished or was cancelled before it started, either way
+        # nothing reads the snapshot any more
+        snapshot.release()
+        _glib.idle_add(self._finished, label, job)
+
+    def _cancel(self, label):
+        job, timer = self._running.pop(label, (None, None))
+        if job is not None:
+            _glib.source_remove(timer)
+            if not job.cancel():
+                self._stuck.add(job)
+
+    def _timed_out(self, label, job):
+        if self._running.get(label, (None,))[0] is job:
+            del self._running[label]
+            if not job.cancel():
+                self._stuck.add(job)
+            _log.warning("Item %r of plugin %r timed out", label, self.name)
+            self.klemmbrett.notify("Klemmbrett", "%s timed out" % (label,))
+        return False
+
+    def _finished(self, label, job):
+        if self._running.get(label, (None,))[0] is not job:
+            # superseded or timed out already
+            return False
+
+        _glib.source_remove(self._running.pop(label)[1])
+
+        try:
+            text = job.result()
+        except HistoryEmpty:
+            _log.info("History is empty")
+            self.klemmbrett.notify("The history is empty", "The history is empty")
+        except Exception:
+            _log.error("Item %r of plugin %r failed", label, self.name, exc_info = True)
+            self.klemmbrett.notify("Klemmbrett", "%s failed" % (label,))
+        else:
+            if text is not None:
+                PopupPlugin.set(self, text = text)
+            self.klemmbrett.notify(
+                "%s finished" % (label,),
+                self._printable(text, htmlsafe = True) if text is not None else "",
+            )
+        return False
+
+    def _perform_action(self, options, argv, callable):
+        input = options.get("action-input", "argv")
+        if input == "argv":
+            _gobject.spawn_async([
+                "/bin/bash",
+                "-c",
+                options["action"] % (callable(),),
+            ]),
+            return
+
+        # no shell and no interpolation, the clipboard is handed to the
+        # command through its stdin or a file
+        text = callable()
+        if text is None:
+            return
+
+        output = options.get("action-output", "none")
+        try:
+            _process.Process(
+                argv,
+                text,
+                _ft.partial(self._action_done, options["action"], output),
+                input = input,
+                capture = output != "none",
+            )
+        except _glib.Error as e:
+            _log.error("Could not run action %r: %s", options["action"], e.message)
+            self.klemmbrett.notify("Klemmbrett", "%s could not be run: %s" % (options["action"], e.message))
+
+    def _action_done(self, command, output, status, text):
+        if status:
+            _log.warning("Action %r exited with status %d", command, status)
+            self.klemmbrett.notify("Klemmbrett", "%s exited with status %d" % (command, status))
+            return
+
+        if not text:
+            return
+        if output == "clipboard":
+            PopupPlugin.set(self, text = text)
+        elif output == "notify":
+            self.klemmbrett.notify(command, self._printable(text, htmlsafe = True))
 
     def set(self, widget = None, text = None):
         return PopupPlugin.set(self, widget = widget, text = text)
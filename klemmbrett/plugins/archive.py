@@ -0,0 +1,248 @@
+# coding: utf-8
+"""
+===========================
+Clipboard archive
+===========================
+
+The `ClipboardArchive` keeps every accepted clip forever, independent of
+the length of the history. Clips are written into one sqlite file per
+month, each with a full-text index, so lookups only open the months they
+are interested in and never load the archive into memory.
+
+You can activate this plugin by adding the following to your
+`klemmbrett.conf` file:
+
+::
+    [plugin archive]
+    plugin = klemmbrett.plugins.archive.ClipboardArchive
+    #archive = ~/.klemmbrett.archive
+    #shortcut = <Ctrl><Alt>F
+
+The shortcut opens a search window over the archive, other code can
+query it directly:
+
+    >>> archive.search("invoice", since = datetime.datetime(2026, 9, 1))
+    [(1757000000.0, "invoice 4711 ..."), ...]
+"""
+
+import os as _os
+import re as _re
+import time as _time
+import sqlite3 as _sqlite
+import logging as _logging
+import datetime as _datetime
+import collections as _collections
+
+from klemmbrett import plugins as _plugins
+
+_log = _logging.getLogger(__name__)
+
+_SHARD = _re.compile(r'^(\d{4}-\d{2})\.sqlite$')
+_TOKEN = _re.compile(r'\w+', _re.U)
+
+
+def _timestamp(value):
+    if value is None or isinstance(value, (int, float)):
+        return value
+    return _time.mktime(value.timetuple())
+
+
+def _shard(stamp):
+    return _time.strftime("%Y-%m", _time.localtime(stamp))
+
+
+def match_expression(query):
+    """ Turn free text into a full-text query matching all words, the last one as a prefix """
+    tokens = _TOKEN.findall(query)
+    if not tokens:
+        return None
+    return " ".join(['"%s"' % (t,) for t in tokens[:-1]] + ['"%s"*' % (tokens[-1],)])
+
+
+class Shard(object):
+    """ One month of the archive """
+
+    def __init__(self, path, index_chars):
+        self.path = path
+        self.name = _SHARD.match(_os.path.basename(path)).group(1)
+        self._index_chars = index_chars
+        self._db = _sqlite.connect(path)
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("PRAGMA synchronous = NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS clips ("
+            "id INTEGER PRIMARY KEY, stamp REAL NOT NULL, text TEXT NOT NULL)"
+        )
+        try:
+            # contentless, the text itself is only stored once in clips
+            self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS clips_fts USING fts5(body, content = '')")
+        except _sqlite.OperationalError:
+            self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS clips_fts USING fts4(body, content = '')")
+        self._db.commit()
+
+    def add(self, stamp, text):
+        with self._db:
+            rowid = self._db.execute(
+                "INSERT INTO clips (stamp, text) VALUES (?, ?)",
+                (stamp, text),
+            ).lastrowid
+            self._db.execute(
+                "INSERT INTO clips_fts (rowid, body) VALUES (?, ?)",
+                (rowid, text[:self._index_chars]),
+            )
+        return rowid
+
+    def search(self, expression, since, until, limit):
+        """ Return (id, stamp) of the newest matching clips """
+        where = []
+        params = []
+        if expression is not None:
+            where.append("id IN (SELECT rowid FROM clips_fts WHERE clips_fts MATCH ?)")
+            params.append(expression)
+        if since is not None:
+            where.append("stamp >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("stamp < ?")
+            params.append(until)
+
+        return self._db.execute(
+            "SELECT id, stamp FROM clips %s ORDER BY id DESC LIMIT ?" % (
+                ("WHERE " + " AND ".join(where)) if where else "",
+            ),
+            params + [limit],
+        ).fetchall()
+
+    def get(self, rowid):
+        row = self._db.execute("SELECT stamp, text FROM clips WHERE id = ?", (rowid,)).fetchone()
+        return tuple(row) if row else None
+
+    def close(self):
+        self._db.close()
+
+
+class ArchiveIndex(object):
+    """ Adapts the archive to the search index interface of the search window """
+
+    def __init__(self, archive):
+        self.archive = archive
+
+    def search(self, needle, within = None):
+        return set(self.archive.find(needle, limit = self.archive.search_results))
+
+    def fuzzy(self, needle, within = None):
+        return set()
+
+
+class ClipboardArchive(_plugins.PopupPlugin):
+
+    DEFAULT_BINDING = "<Ctrl><Alt>F"
+    FILES = ("archive",)
+    OPTIONS = {
+        "tie:history": "history",
+        "popup-mode": "search",
+    }
+
+    def __init__(self, name, options, klemmbrett):
+        _plugins.PopupPlugin.__init__(self, name, options, klemmbrett)
+        self._path = _os.path.expanduser(self.options.get("archive", "~/.klemmbrett.archive"))
+        self._index_chars = int(self.options.get("index-chars", 65536))
+        self._max_open = int(self.options.get("open-shards", 4))
+        self.search_results = int(self.options.get("search-results", 50))
+        self._shards = _collections.OrderedDict()
+        # counts the clips archived, the menu is rebuilt when it changes
+        self.generation = 0
+        _os.makedirs(self._path, exist_ok = True)
+
+    def bootstrap(self):
+        _plugins.PopupPlugin.bootstrap(self)
+        self.history.connect("text-accepted", self._text_accepted)
+
+    def _text_accepted(self, widget, text):
+        stamp = _time.time()
+        try:
+            self._open(_shard(stamp)).add(stamp, text)
+        except _sqlite.Error:
+            _log.error("Could not archive clip", exc_info = True)
+        else:
+            self.generation += 1
+        return True
+
+    def _open(self, name):
+        """ Return the shard of the given month, keeping a few of them open """
+        try:
+            self._shards.move_to_end(name)
+            return self._shards[name]
+        except KeyError:
+            pass
+
+        shard = self._shards[name] = Shard(
+            _os.path.join(self._path, "%s.sqlite" % (name,)),
+            self._index_chars,
+        )
+        while len(self._shards) > self._max_open:
+            self._shards.popitem(last = False)[1].close()
+        return shard
+
+    def _shard_names(self, since, until):
+        """ Names of all shards possibly holding clips between since and until, newest first """
+        names = []
+        for filename in _os.listdir(self._path):
+            m = _SHARD.match(filename)
+            if not m:
+                continue
+            name = m.group(1)
+            if since is not None and name < _shard(since):
+                continue
+            if until is not None and name > _shard(until):
+                continue
+            names.append(name)
+        return sorted(names, reverse = True)
+
+    def find(self, query, since = None, until = None, limit = 50):
+        """
+            Return (month, id) keys of the newest clips containing all words
+            of query, only looking at as many months as needed for limit
+        """
+        since, until = _timestamp(since), _timestamp(until)
+        expression = match_expression(query)
+        keys = []
+
+        for name in self._shard_names(since, until):
+            rows = self._open(name).search(expression, since, until, limit - len(keys))
+            keys.extend((name, rowid) for rowid, stamp in rows)
+            if len(keys) >= limit:
+                break
+
+        return keys
+
+    def get(self, key):
+        """ Return (timestamp, text) of the clip with the given key """
+        name, rowid = key
+        return self._open(name).get(rowid)
+
+    def search(self, query, since = None, until = None, limit = 50):
+        """ Return (timestamp, text) of the newest clips containing all words of query """
+        return [self.get(key) for key in self.find(query, since, until, limit)]
+
+    def items(self):
+        return self._search_items(self.find(""), self.search_results)
+
+    def _items_stamp(self):
+        return self.generation
+
+    def _search_index(self):
+        return ArchiveIndex(self)
+
+    def _search_items(self, keys, limit):
+        items = []
+        for key in sorted(keys, reverse = True)[:limit]:
+            stamp, text = self.get(key)
+            items.append((
+                "%s %s" % (
+                    _datetime.datetime.fromtimestamp(stamp).strftime("%Y-%m-%d %H:%M"),
+                    self._printable(text),
+                ),
+                text,
+            ))
+        return items
@@ -16,8 +16,6 @@ import gi as _gi
 _gi.require_version('Gdk', '3.0')
 from gi.repository import Gdk as _gdk
 from gi.repository import GObject as _gobject
-_gi.require_version('Keybinder', '3.0')
-from gi.repository import Keybinder as _keybinder
 
 import Crypto.Cipher.AES as _aes
 
@@ -256,12 +254,12 @@ class ClipboardExchange(_plugins.PopupPlugin):
         self._current_suggestion = None
 
         # binding to accept the suggested text into the clipboard
-        _keybinder.bind(
+        self.klemmbrett.bind(
             self.options.get('accept-suggestion-shortcut', self.DEFAULT_ACCEPT_BINDING),
             self._accept_suggestion,
         )
 
-        _keybinder.bind(
+        self.klemmbrett.bind(
             self.options.get('user-history-shortcut', self.DEFAULT_USERHISTORY_BINDING),
             self._show_histories,
         )
@@ -269,9 +267,15 @@ class ClipboardExchange(_plugins.PopupPlugin):
         _plugins.PopupPlugin.bootstrap(self)
         self._start_server()
 
-    def _show_histories(self):
+    def _show_histories(self, keystr):
         """ Popup a dropdown menu with a submenu per user containing their history """
-        return self.popup(((x["name"], x["history"].items) for x in self._destinations.values()))
+        items = []
+        for dest in self._destinations.values():
+            history = _util.yieldwrap(dest["history"].items)
+            # the submenu is kept until the history changes
+            history.stamp = _ft.partial(getattr, dest["history"], "generation")
+            items.append((dest["name"], history))
+        return self.popup(keystr, items)
 
     def _serve(self):
         """ Middleman for the Thread ctors target argument """
@@ -326,13 +330,13 @@ class ClipboardExchange(_plugins.PopupPlugin):
         for dest in self._destinations.values():
             yield (
                 dest["name"],
-                _ft.partial(self._send_text, dest["url"], self.history.top),
+                _ft.partial(self._send_text, dest["url"]),
             )
 
-    def _send_text(self, dest, text):
+    def _send_text(self, dest):
         """
-            Callback for the items method. sends a suggestion to the desired
-            destination
+            Callback for the items method. sends the current clipboard
+            contents as a suggestion to the desired destination
         """
         p =  _xmlrpc.ServerProxy(
             dest,
@@ -341,4 +345,4 @@ class ClipboardExchange(_plugins.PopupPlugin):
                 self.options["hmac-key"],
             ),
         )
-        p.suggest(text)
+        p.suggest(self.history.top)
@@ -1,19 +1,19 @@
 # coding: utf-8
 import os as _os
 
-import gi as _gi
-_gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk as _gtk
-_gi.require_version('AppIndicator3', '0.1')
-from gi.repository import AppIndicator3 as _appindicator
 from klemmbrett import plugins as _plugins
 
 import klemmbrett.util as _util
 import klemmbrett.about as _about
 
+_gtk = _util.Repository('Gtk', '3.0')
+_appindicator = _util.Repository('AppIndicator3', '0.1')
+
 
 class AppIndicatorPlugin(_plugins.Plugin):
 
+    WIDGET = True
+
     def __init__(self, *args, **kwargs):
         super(AppIndicatorPlugin, self).__init__(*args, **kwargs)
 
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+import os as _os
+import errno as _errno
+import tempfile as _tempfile
+
+from gi.repository import GLib as _glib
+
+import klemmbrett.util as _util
+
+_CHUNK = 64 * 1024
+
+
+class Process(object):
+    """
+        Run argv without a shell and hand it text, either streamed to its
+        stdin from the main loop or as a temporary file whose path replaces
+        %s in argv (or is appended to it). done(status, output) is called on
+        the main loop once the child exited, output is its stdout if
+        capture is set and None otherwise.
+    """
+
+    INPUTS = ("stdin", "file")
+
+    def __init__(self, argv, text, done, input = "stdin", capture = False):
+        self._done = done
+        self._payload = memoryview(_util.encode(text))
+        self._output = [] if capture else None
+        self._status = None
+        self._tempfile = None
+        self._open = 0
+
+        if input not in self.INPUTS:
+            raise ValueError("Unknown input %r, expected one of %s" % (input, ", ".join(self.INPUTS)))
+
+        if input == "file":
+            argv = self._file_argv(argv)
+
+        try:
+            pid, stdin, stdout, stderr = _glib.spawn_async(
+                argv,
+                flags = _glib.SpawnFlags.SEARCH_PATH | _glib.SpawnFlags.DO_NOT_REAP_CHILD,
+                standard_input = input == "stdin",
+                standard_output = capture,
+            )
+        except _glib.Error:
+            # e.g. the command does not exist, the child never got the file
+            if self._tempfile is not None:
+                _os.unlink(self._tempfile)
+            raise
+        self.pid = pid
+
+        if stdin is not None:
+            _os.set_blocking(stdin, False)
+            self._watch(stdin, _glib.IOCondition.OUT, self._write)
+        if stdout is not None:
+            _os.set_blocking(stdout, False)
+            self._watch(stdout, _glib.IOCondition.IN, self._read)
+
+        _glib.child_watch_add(_glib.PRIORITY_DEFAULT, pid, self._exited)
+
+    def _file_argv(self, argv):
+        fd, self._tempfile = _tempfile.mkstemp(prefix = "klemmbrett-")
+        with _os.fdopen(fd, "wb") as fp:
+            fp.write(self._payload)
+        self._payload = memoryview(b"")
+
+        if not any("%s" in arg for arg in argv):
+            return list(argv) + [self._tempfile]
+        return [arg.replace("%s", self._tempfile) for arg in argv]
+
+    def _watch(self, fd, condition, callback):
+        self._open += 1
+        _glib.io_add_watch(
+            fd,
+            _glib.PRIORITY_DEFAULT,
+            condition | _glib.IOCondition.HUP | _glib.IOCondition.ERR,
+            callback,
+        )
+
+    def _closed(self, fd):
+        _os.close(fd)
+        self._open -= 1
+        self._finish()
+        return False
+
+    def _write(self, fd, condition):
+        if condition & (_glib.IOCondition.HUP | _glib.IOCondition.ERR):
+            # the child does not read its stdin (any more)
+            return self._closed(fd)
+
+        try:
+            written = _os.write(fd, self._payload[:_CHUNK])
+        except BlockingIOError:
+            return True
+        except BrokenPipeError:
+            return self._closed(fd)
+
+        self._payload = self._payload[written:]
+        if not self._payload:
+            return self._closed(fd)
+        return True
+
+    def _read(self, fd, condition):
+        try:
+            data = _os.read(fd, _CHUNK)
+        except BlockingIOError:
+            return True
+        except OSError as e:
+            if e.errno != _errno.EIO:
+                raise
+            data = b""
+
+        if not data:
+            return self._closed(fd)
+        self._output.append(data)
+        return True
+
+    def _exited(self, pid, status):
+        pid.close()
+        self._status = _os.waitstatus_to_exitcode(status)
+        self._finish()
+
+    def _finish(self):
+        # both the exit status and the end of the output have to be there
+        if self._status is None or self._open:
+            return
+
+        if self._tempfile is not None:
+            _os.unlink(self._tempfile)
+
+        output = None
+        if self._output is not None:
+            output = b"".join(self._output).decode("utf-8", "replace")
+        self._done(self._status, output)
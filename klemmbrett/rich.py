@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+import re as _re
+import html as _html
+import collections as _collections
+
+import klemmbrett.util as _util
+import klemmbrett.storage as _storage
+
+_pixbuf = _util.Repository('GdkPixbuf', '2.0')
+
+_TAG = _re.compile(r'<[^>]*>')
+_HIDDEN = _re.compile(r'<(head|script|style)\b.*?</\1\s*>', _re.I | _re.S)
+_BREAK = _re.compile(r'<(br|/p|/div|/li|/tr|/h[1-6])\b[^>]*>', _re.I)
+
+
+def html_text(html):
+    """ The whole text of html, for when the source offered none along with it """
+    text = _HIDDEN.sub("", html)
+    text = _BREAK.sub("\n", text)
+    return _html.unescape(_TAG.sub("", text))
+
+
+class Clip(object):
+    """
+        Descriptor of clipboard contents that are not (only) text. The data
+        itself is kept in the store, the descriptor only knows how to find
+        it and a text to show and search for in its place.
+    """
+
+    __slots__ = ("_store", "mime", "digest", "size", "text", "width", "height")
+
+    def __init__(self, store, mime, digest, size, text, width = None, height = None):
+        self._store = store
+        self.mime = mime
+        self.digest = digest
+        self.size = size
+        self.text = text
+        self.width = width
+        self.height = height
+
+    @property
+    def data(self):
+        return self._store.get(self.digest)
+
+    @property
+    def image(self):
+        return self.mime.startswith("image/")
+
+    def thumbnail(self, size):
+        return self._store.thumbnail(self, size)
+
+    def pixbuf(self):
+        return self._store.pixbuf(self)
+
+    def retain(self):
+        """ Take another reference to the data, to be given up with discard """
+        self._store.retain(self.digest)
+
+    def discard(self):
+        """ Give up this reference to the data, it is removed after the last one """
+        self._store.release(self.digest)
+
+
+class RichStore(object):
+    """
+        Content addressed store for images, markup and file lists copied to the
+        clipboard, the same contents copied again are stored only once.
+        Thumbnails are made when they are first asked for and a few of them
+        are kept around.
+    """
+
+    def __init__(self, path, thumbnails = 32):
+        # clips are only referenced by the in memory history of this process
+        self._blobs = _storage.BlobStore.private(path, "rich-")
+        self._thumbnails = _collections.OrderedDict()
+        self._thumbnails_max = thumbnails
+        # the same contents may be described by several clips
+        self._refs = _collections.Counter()
+
+    def put(self, mime, data, text, width = None, height = None):
+        digest = _util.digest(data)
+        self._blobs.put(digest, data)
+        self._refs[digest] += 1
+        return Clip(self, mime, digest, len(data), text, width, height)
+
+    def put_image(self, pixbuf):
+        ok, data = pixbuf.save_to_bufferv("png", [], [])
+        width, height = pixbuf.get_width(), pixbuf.get_height()
+        return self.put(
+            "image/png",
+            data,
+            "[image %dx%d]" % (width, height),
+            width,
+            height,
+        )
+
+    def put_html(self, html, text = None):
+        if not text:
+            text = html_text(str(html, "utf-8", "replace"))
+        return self.put("text/html", html, text)
+
+    def put_uris(self, uris):
+        data = "".join(uri + "\r\n" for uri in uris).encode("utf-8")
+        return self.put("text/uri-list", data, "\n".join(uris))
+
+    def get(self, digest):
+        return self._blobs.get_bytes(digest)
+
+    def retain(self, digest):
+        self._refs[digest] += 1
+
+    def release(self, digest):
+        self._refs[digest] -= 1
+        if self._refs[digest] > 0:
+            return
+
+        del self._refs[digest]
+        for key in [key for key in self._thumbnails if key[0] == digest]:
+            del self._thumbnails[key]
+        self._blobs.remove(digest)
+
+    def pixbuf(self, clip):
+        loader = _pixbuf.PixbufLoader()
+        loader.write(clip.data)
+        loader.close()
+        return loader.get_pixbuf()
+
+    def thumbnail(self, clip, size):
+        """ Return clip scaled down to fit into size x size pixels """
+        key = (clip.digest, size)
+        try:
+            self._thumbnails.move_to_end(key)
+            return self._thumbnails[key]
+        except KeyError:
+            pass
+
+        scale = min(1.0, float(size) / max(clip.width, clip.height, 1))
+        pixbuf = self.pixbuf(clip).scale_simple(
+            max(1, int(clip.width * scale)),
+            max(1, int(clip.height * scale)),
+            _pixbuf.InterpType.BILINEAR,
+        )
+
+        self._thumbnails[key] = pixbuf
+        while len(self._thumbnails) > self._thumbnails_max:
+            self._thumbnails.popitem(last = False)
+        return pixbuf
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+import re as _re
+
+
+class TrigramIndex(object):
+    """
+        Substring index over a set of texts. Every text is indexed by the
+        trigrams of its first limit characters, a query only verifies the
+        texts sharing all of the trigrams of the needle.
+    """
+
+    def __init__(self, limit = 1024):
+        self.limit = limit
+        self._docs = dict()
+        self._postings = dict()
+
+    @staticmethod
+    def _trigrams(text):
+        return set(text[i:i + 3] for i in range(len(text) - 2))
+
+    def add(self, key, text):
+        if key in self._docs:
+            self.remove(key)
+
+        doc = self._docs[key] = text[:self.limit].lower()
+        for trigram in self._trigrams(doc):
+            self._postings.setdefault(trigram, set()).add(key)
+
+    def remove(self, key):
+        doc = self._docs.pop(key, None)
+        if doc is None:
+            return
+
+        for trigram in self._trigrams(doc):
+            keys = self._postings[trigram]
+            keys.discard(key)
+            if not keys:
+                del self._postings[trigram]
+
+    def __contains__(self, key):
+        return key in self._docs
+
+    def __len__(self):
+        return len(self._docs)
+
+    def search(self, needle, within = None):
+        """
+            Return the keys of all texts containing needle, ignoring case.
+            Passing the result of a query for a prefix of needle as within
+            narrows that result down instead of querying the whole index.
+        """
+        needle = needle.lower()
+        if not needle:
+            return set(self._docs if within is None else within)
+
+        if within is not None:
+            candidates = within
+        elif len(needle) < 3:
+            candidates = self._docs
+        else:
+            postings = sorted(
+                (self._postings.get(trigram, ()) for trigram in self._trigrams(needle)),
+                key = len,
+            )
+            candidates = set(postings[0])
+            for keys in postings[1:]:
+                if not candidates:
+                    break
+                candidates &= keys
+
+        docs = self._docs
+        return set(key for key in candidates if key in docs and needle in docs[key])
+
+    def fuzzy(self, needle, within = None):
+        """ Return the keys of all texts containing the characters of needle in order """
+        pattern = _re.compile(".*?".join(_re.escape(c) for c in needle.lower()), _re.S)
+        docs = self._docs
+        candidates = docs if within is None else within
+        return set(key for key in candidates if key in docs and pattern.search(docs[key]))
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+
+import os as _os
+import mmap as _mmap
+import atexit as _atexit
+import struct as _struct
+import pickle as _pickle
+import shutil as _shutil
+import logging as _logging
+import tempfile as _tempfile
+import threading as _threading
+import collections as _collections
+
+
+_log = _logging.getLogger(__name__)
+
+MAGIC = b"KLEMMBRETT-LOG\x01\n"
+_FRAME = _struct.Struct(">I")
+
+
+class CorruptLog(Exception):
+    pass
+
+
+class MissingBlob(LookupError):
+    pass
+
+
+def _frame(record):
+    payload = _pickle.dumps(record, protocol = _pickle.HIGHEST_PROTOCOL)
+    return _FRAME.pack(len(payload)) + payload + _FRAME.pack(len(payload))
+
+
+class HistoryLog(object):
+    """
+        Append-only log of pickled records.
+
+        Every record is framed by its payload length in front of and
+        behind the payload, so the log can be walked backwards from its
+        tail and the newest records can be read without touching the
+        older ones.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # number of records in the file, None while we do not know
+        self.records = None
+        self._fp = None
+        self._lock = _threading.Lock()
+        self._appended = 0
+        self._compacting = False
+
+    def open(self, count, key = None):
+        """
+            Return up to count of the newest records, oldest first, and open
+            the log for appending. With a key function records with the same
+            key count once, only the newest of them is returned.
+        """
+        records = []
+
+        if _os.path.exists(self.path) and _os.path.getsize(self.path):
+            with open(self.path, "br") as fp:
+                legacy = fp.read(len(MAGIC)) != MAGIC
+
+            if legacy:
+                records = self._migrate(count, key)
+            else:
+                try:
+                    records, frames = self._tail(count, key)
+                except CorruptLog:
+                    _log.warning("History log %r is damaged, recovering", self.path, exc_info = True)
+                    self._recover()
+                    records, frames = self._tail(count, key)
+
+                self.records = frames
+        else:
+            with open(self.path, "bw") as fp:
+                fp.write(MAGIC)
+            self.records = 0
+
+        self._fp = open(self.path, "ba")
+        return [record for _, record in reversed(records)]
+
+    def close(self):
+        with self._lock:
+            if self._fp is not None:
+                self._fp.close()
+                self._fp = None
+
+    def append(self, record):
+        frame = _frame(record)
+
+        with self._lock:
+            self._fp.write(frame)
+            self._fp.flush()
+            self._appended += 1
+            if self.records is not None:
+                self.records += 1
+
+    def dead(self, keep):
+        """ Number of records beyond keep, None if unknown """
+        if self.records is None:
+            return None
+        return max(0, self.records - keep)
+
+    def compact(self, records, done = None):
+        """
+            Rewrite the log in a background thread so it only contains
+            records, a function returning them oldest first that is called
+            in that thread. Records appended while the compaction is running
+            are carried over into the new file. done is called once the
+            records are not needed any more.
+        """
+        with self._lock:
+            if self._compacting or self._fp is None:
+                if done is not None:
+                    done()
+                return False
+            self._compacting = True
+            self._fp.flush()
+            snapshot = self._fp.tell()
+            appended = self._appended
+
+        t = _threading.Thread(target = self._compact, args = (records, done, snapshot, appended))
+        t.daemon = True
+        t.start()
+        return True
+
+    def _compact(self, records, done, snapshot, appended):
+        tmp = self.path + ".compact"
+        try:
+            frames = 0
+            with open(tmp, "bw") as out:
+                out.write(MAGIC)
+                for record in records():
+                    out.write(_frame(record))
+                    frames += 1
+
+                with self._lock:
+                    self._fp.flush()
+                    with open(self.path, "br") as src:
+                        src.seek(snapshot)
+                        _shutil.copyfileobj(src, out)
+
+                    out.flush()
+                    _os.fsync(out.fileno())
+                    _os.replace(tmp, self.path)
+
+                    self._fp.close()
+                    self._fp = open(self.path, "ba")
+                    self.records = frames + self._appended - appended
+        except Exception:
+            _log.error("Compacting history log %r failed", self.path, exc_info = True)
+        finally:
+            self._compacting = False
+            if done is not None:
+                done()
+
+    def _tail(self, count, key = None):
+        """
+            Walk the log backwards from its end and collect up to count
+            records as (offset, record) tuples, newest first, see open for
+            key. The second return value is the number of records in the
+            log if the walk reached its start, None otherwise.
+        """
+        records = []
+        seen = set()
+        frames = 0
+
+        with open(self.path, "br") as fp:
+            pos = fp.seek(0, _os.SEEK_END)
+
+            while pos > len(MAGIC) and len(records) < count:
+                if pos - len(MAGIC) < 2 * _FRAME.size:
+                    raise CorruptLog("Truncated frame at offset %d" % (pos,))
+
+                fp.seek(pos - _FRAME.size)
+                size, = _FRAME.unpack(fp.read(_FRAME.size))
+                start = pos - size - 2 * _FRAME.size
+                if start < len(MAGIC):
+                    raise CorruptLog("Frame at offset %d exceeds the log" % (pos,))
+
+                fp.seek(start)
+                frame = fp.read(size + 2 * _FRAME.size)
+                if _FRAME.unpack(frame[:_FRAME.size]) != (size,):
+                    raise CorruptLog("Frame at offset %d has mismatching headers" % (start,))
+
+                record = _pickle.loads(frame[_FRAME.size:-_FRAME.size])
+                frames += 1
+                pos = start
+
+                if key is not None:
+                    if key(record) in seen:
+                        continue
+                    seen.add(key(record))
+                records.append((start, record))
+
+        return records, frames if pos <= len(MAGIC) else None
+
+    def _recover(self):
+        """ Scan the log from the start and cut off everything after the last intact frame """
+        with open(self.path, "br+") as fp:
+            total = fp.seek(0, _os.SEEK_END)
+            pos = len(MAGIC)
+            records = 0
+
+            while pos + 2 * _FRAME.size <= total:
+                fp.seek(pos)
+                size, = _FRAME.unpack(fp.read(_FRAME.size))
+                end = pos + size + 2 * _FRAME.size
+                if end > total:
+                    break
+
+                fp.seek(end - _FRAME.size)
+                if _FRAME.unpack(fp.read(_FRAME.size)) != (size,):
+                    break
+
+                pos = end
+                records += 1
+
+            fp.truncate(pos)
+
+        self.records = records
+
+    def _migrate(self, count, key = None):
+        """ Convert a plain pickle stream, as written by older versions, into the framed format """
+        stream = []
+
+        with open(self.path, "br") as fp:
+            while True:
+                try:
+                    stream.append(_pickle.load(fp))
+                except EOFError:
+                    break
+                except _pickle.UnpicklingError:
+                    _log.warning("Stopped reading damaged legacy history %r", self.path, exc_info = True)
+                    break
+
+        # newest first, like _tail
+        records = []
+        seen = set()
+        for record in reversed(stream):
+            if len(records) >= count:
+                break
+            if key is not None:
+                if key(record) in seen:
+                    continue
+                seen.add(key(record))
+            records.append(record)
+
+        tmp = self.path + ".compact"
+        with open(tmp, "bw") as out:
+            out.write(MAGIC)
+            for record in reversed(records):
+                out.write(_frame(record))
+            out.flush()
+            _os.fsync(out.fileno())
+        _os.replace(tmp, self.path)
+
+        self.records = len(records)
+        return [(None, record) for record in records]
+
+
+class BlobStore(object):
+    """
+        Content addressed store for large payloads. Every blob is a file
+        named after the digest of its contents and is read back through
+        a memory map. Blobs pinned by readers in other threads are only
+        removed once the last of them let go.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        _os.makedirs(self.path, exist_ok = True)
+        self._lock = _threading.Lock()
+        self._pins = _collections.Counter()
+        # removed while pinned, deleted when unpinned
+        self._doomed = set()
+
+    @classmethod
+    def private(cls, parent, prefix):
+        """
+            Return a store in a new directory below parent, which no other
+            process uses and which is removed when this one exits
+        """
+        _os.makedirs(parent, exist_ok = True)
+        path = _tempfile.mkdtemp(prefix = prefix, dir = parent)
+        _atexit.register(_shutil.rmtree, path, True)
+        return cls(path)
+
+    def _blob(self, digest):
+        name = digest.hex()
+        return _os.path.join(self.path, name[:2], name[2:])
+
+    def put(self, digest, data):
+        path = self._blob(digest)
+        with self._lock:
+            self._doomed.discard(digest)
+        if _os.path.exists(path):
+            return
+
+        _os.makedirs(_os.path.dirname(path), exist_ok = True)
+        tmp = path + ".tmp"
+        with open(tmp, "bw") as fp:
+            fp.write(data)
+        _os.replace(tmp, path)
+
+    def _open(self, digest):
+        try:
+            return open(self._blob(digest), "br")
+        except FileNotFoundError:
+            raise MissingBlob("Blob %s is gone from %r" % (digest.hex(), self.path)) from None
+
+    def get(self, digest):
+        """ Return the blob decoded as text """
+        with self._open(digest) as fp:
+            with _mmap.mmap(fp.fileno(), 0, access = _mmap.ACCESS_READ) as mm:
+                return str(mm, "utf-8", "surrogatepass")
+
+    def get_bytes(self, digest):
+        with self._open(digest) as fp:
+            return fp.read()
+
+    def pin(self, digests):
+        """ Keep the given blobs until they are unpinned, even if they are removed """
+        with self._lock:
+            self._pins.update(digests)
+
+    def unpin(self, digests):
+        with self._lock:
+            self._pins.subtract(digests)
+            for digest in digests:
+                if self._pins[digest] > 0:
+                    continue
+                del self._pins[digest]
+                if digest in self._doomed:
+                    self._doomed.discard(digest)
+                    self._unlink(digest)
+
+    def remove(self, digest):
+        with self._lock:
+            if self._pins[digest] > 0:
+                self._doomed.add(digest)
+                return
+            self._unlink(digest)
+
+    def _unlink(self, digest):
+        try:
+            _os.unlink(self._blob(digest))
+        except FileNotFoundError:
+            pass
@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 
+import re as _re
 import html as _html
+import hashlib as _hashlib
+import importlib as _importlib
 import pkg_resources as _pr
 import distutils.util as _util
 
@@ -17,10 +20,10 @@ def get_status_icon_filename():
 
 def isgenerator(func):
     """ Check if a given function is a generator before calling it """
-    try:
-        return func.func_code.co_flags & CO_GENERATOR != 0
-    except AttributeError:
+    code = getattr(func, "__code__", getattr(func, "func_code", None))
+    if code is None:
         return False
+    return code.co_flags & CO_GENERATOR != 0
 
 
 def yieldwrap(func, *args, **kwargs):
@@ -58,7 +61,111 @@ def load_dotted(name):
     return obj
 
 
+class Repository(object):
+    """
+        A gi.repository module that is only imported once it is used, so
+        that klemmbrett can be imported and run without a display
+    """
+
+    def __init__(self, name, version = None):
+        self._name = name
+        self._version = version
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            import gi
+            if self._version is not None:
+                gi.require_version(self._name, self._version)
+            self._module = _importlib.import_module("gi.repository." + self._name)
+        return getattr(self._module, attr)
+
+
 def htmlsafe(text):
     """ Escape htmlentities """
     return _html.escape(text)
 
+
+
+def encode(text):
+    """ Encode text for hashing and size accounting """
+    return text.encode("utf-8", "surrogatepass")
+
+
+def digest(data):
+    """ Return a content hash of the given text or bytes """
+    if isinstance(data, str):
+        data = encode(data)
+    return _hashlib.blake2b(data, digest_size = 16).digest()
+
+
+_BYTESIZE_UNITS = {
+    "": 1,
+    "k": 1024,
+    "m": 1024 ** 2,
+    "g": 1024 ** 3,
+}
+
+
+def bytesize(value):
+    """ Convert a size like 512, 64k or 1.5M to a number of bytes """
+    value = str(value).strip().lower().rstrip("b")
+    unit = value[-1:] if value[-1:] in _BYTESIZE_UNITS else ""
+    return int(float(value[:len(value) - len(unit)] or 0) * _BYTESIZE_UNITS[unit])
+
+
+_WHITESPACE = _re.compile(r'\s+')
+
+
+def printable_ends(head, tail, line_length = 30, omit_mode = 'middle'):
+    """
+        Build the single line preview of a text from its head and tail only.
+        Returns None if the given ends are too short to be sure about the
+        result, in which case more of the text is needed.
+    """
+    if omit_mode not in ('start', 'middle', 'end'):
+        return None
+
+    head = _WHITESPACE.sub(' ', head).lstrip()
+    tail = _WHITESPACE.sub(' ', tail).rstrip()
+
+    # a whitespace run may continue beyond the ends, so one character
+    # more than shown is needed to know the text gets shortened at all
+    if len(head) <= line_length + 1 or len(tail) <= line_length + 1:
+        return None
+
+    if omit_mode == 'start':
+        return tail[len(tail) - line_length:]
+    elif omit_mode == 'middle':
+        half = int(line_length / 2)
+        return head[:half] + " ... " + tail[len(tail) - half:]
+    return head[:line_length]
+
+
+def printable(text, line_length = 30, omit_mode = 'middle', htmlsafe = False):
+    """
+        Collapse whitespace and shorten text to line_length according to
+        omit_mode, only looking at as much of both ends as required
+    """
+    window = 2 * line_length + 16
+    clean = None
+
+    while clean is None and 2 * window < len(text):
+        clean = printable_ends(text[:window], text[len(text) - window:], line_length, omit_mode)
+        window *= 4
+
+    if clean is None:
+        clean = _WHITESPACE.sub(' ', text).strip()
+
+        if len(clean) > line_length:
+            if omit_mode == 'start':
+                clean = clean[len(clean) - line_length:]
+            elif omit_mode == 'middle':
+                clean = clean[:int(line_length / 2)] + " ... " + clean[len(clean) - int(line_length / 2):]
+            elif omit_mode == 'end':
+                clean = clean[:line_length]
+
+    if htmlsafe:
+        clean = _html.escape(clean)
+
+    return clean